@@ -1,6 +1,8 @@
 import sounddevice as sd
+import numpy as np
 import queue
 from enum import Enum
+from time import monotonic
 
 
 class DeviceType(Enum):
@@ -27,6 +29,81 @@ class AudioDevice:
         
 
 
+class VoiceActivityDetector:
+    """
+    Detects speech in captured audio blocks from their level and zero-crossing
+    rate, against the background noise tracked in the blocks without speech.
+    Speech lasts for a hangover time after the last speech block, so that the
+    quiet ends of words are not cut.
+    """
+
+    THRESHOLD = .01
+    """RMS level (of samples in [-1, 1]) a block must exceed to be speech, about -40 dBFS"""
+    NOISE_RATIO = 3.
+    """Ratio of RMS levels a block must exceed the background noise by to be speech"""
+    ZCR_THRESHOLD = .25
+    """Zero-crossing rate above which a quieter block is an unvoiced sound, such as s or f"""
+    NOISE_RISE = .05
+    """Weight of the level of a block in the background noise when it rises"""
+    HANGOVER = .3
+    """Time (s) speech lasts after the last speech block"""
+
+
+    def __init__(self):
+        self.noise = None
+        """RMS level of the background noise, `None` before the first block"""
+        self.speech_time = -np.inf
+        """Time of the last speech block"""
+
+
+    def detect(self, data: np.ndarray, timestamp: float) -> bool:
+        """
+        Classify a captured audio block
+
+        Parameters
+        -----------
+        data: np.ndarray
+            Float samples in [-1, 1] of shape (frames, channels)
+
+        timestamp: float
+            Time the block was captured at
+
+        Returns
+        ---------
+        Whether the block is speech, or within the hangover after it
+        """
+        mono = data.mean(axis=1) if data.ndim > 1 else data
+        if len(mono) == 0: return timestamp - self.speech_time <= VoiceActivityDetector.HANGOVER
+
+        level = float(np.sqrt(np.mean(np.square(mono))))
+        zcr = float(np.mean(np.signbit(mono[1:]) != np.signbit(mono[:-1]))) if len(mono) > 1 else 0.
+
+        threshold = VoiceActivityDetector.THRESHOLD
+        if self.noise is not None:
+            threshold = max(threshold, VoiceActivityDetector.NOISE_RATIO * self.noise)
+
+        # voiced sounds are loud, unvoiced ones are quieter but cross zero often
+        speech = level > threshold or (level > threshold / 2 and zcr > VoiceActivityDetector.ZCR_THRESHOLD)
+
+        if speech:
+            self.speech_time = timestamp
+
+        # follow the background noise down at once, and up slowly
+        elif self.noise is None or level < self.noise:
+            self.noise = level
+        else:
+            self.noise += VoiceActivityDetector.NOISE_RISE * (level - self.noise)
+
+        return timestamp - self.speech_time <= VoiceActivityDetector.HANGOVER
+
+
+    def reset(self):
+        """Forget the background noise and speech, when capturing starts again"""
+        self.noise = None
+        self.speech_time = -np.inf
+
+
+
 class Audio:
     """Handles audio capture and play"""
 
@@ -37,10 +114,11 @@ class Audio:
 
         if status: print(status)
 
-        # copy captured audio data from device buffer
+        # copy captured audio data from device buffer, with the time it started at
         data = indata.copy()
+        timestamp = monotonic() - frames / self._input_device.sample_rate
         try:
-            self._input_buffer.put_nowait(data)
+            self._input_buffer.put_nowait((data, timestamp))
         except queue.Full:
             return
 
@@ -53,8 +131,14 @@ class Audio:
         # copy playback audio data to device output
         try:
             outdata[:frames] = self._output_buffer.get_nowait()
+
+        # fill the gaps in the audio received with noise like the background of
+        # the silent speakers, or with silence
         except queue.Empty:
-            outdata = []
+            if self.comfort_noise > 0:
+                outdata[:] = self._noise.normal(0, self.comfort_noise, outdata.shape)
+            else:
+                outdata.fill(0)
 
 
 
@@ -81,6 +165,21 @@ class Audio:
         )
         self._output_buffer = queue.Queue()
 
+        self.comfort_noise = 0.
+        """RMS level of the noise played when no audio is received, 0 for silence"""
+        self._noise = np.random.default_rng()
+
+
+    @property
+    def input_rate(self) -> int:
+        """Sample rate of the captured audio"""
+        return self._input_device.sample_rate
+
+    @property
+    def input_channels(self) -> int:
+        """Number of channels of the captured audio"""
+        return self._input_device.channels
+
 
     def start_capturing(self):
         self._input_stream.start()
@@ -103,7 +202,13 @@ class Audio:
 
 
     def capture(self):
-        """Capture audio from microphone"""
+        """
+        Capture audio from microphone
+
+        Returns
+        ---------
+        Audio data and the time it was captured at, or `None` if no audio is available
+        """
         try:
             data = self._input_buffer.get_nowait()
             return data
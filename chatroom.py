@@ -1,13 +1,23 @@
 from status_type import StatusType
-from recorder import Recorder
+from recorder import Recorder, Recording, RecordingFile, ReplayBuffer, WavIndex
+from codec import AUDIO_CODECS, AUDIO_CODEC_IDS
 
+import os
+import datetime
+import tempfile
 import asyncio
 import websockets
 import json
+import mmap
+import struct
+import time
+import zlib
+import numpy as np
 from enum import Enum
-from math import ceil
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from config import HOST
+from config import RECORDING_DOWNLOAD_RATE, RECORDING_FORMAT, RECORDING_REPLAY, REQUEST_TIMEOUT, AUDIO_SPEAKERS, VIDEO_LAST_N, AUDIO_CODEC
 
 
 class ParticipantData:
@@ -16,12 +26,24 @@ class ParticipantData:
     def __init__(self, *,
                  id: int,
                  microphone: bool = True, speaker: bool = True, webcam: bool = False,
-                 image: list = None):
+                 image: list = None, frame: int = 0,
+                 tiles: list = None, grid: list = None, size: list = None,
+                 video: bool = True):
         self.id = id
         self.microphone = microphone
         self.speaker = speaker
         self.webcam = webcam
         self.image = image
+        self.frame = frame
+        """Number of webcam images received, identifies the latest one"""
+        self.tiles = tiles
+        """Webcam image sent as tiles, instead of `image`"""
+        self.grid = grid
+        """Number of rows and columns of `tiles`"""
+        self.size = size
+        """Height and width of the image composed of `tiles`"""
+        self.video = video
+        """Whether the webcam images are sent to the receiver, a placeholder is shown otherwise"""
 
 
     def __eq__(self, value: object) -> bool:
@@ -52,28 +74,212 @@ class EventType(Enum):
         # client status
         TOGGLE_MICROPHONE, TOGGLE_SPEAKER, TOGGLE_WEBCAM,
 
-    ) = list(range(14))
+        # congestion feedback for webcam streaming
+        VIDEO_FEEDBACK,
+
+        # request all tiles of a webcam image
+        REQUEST_KEYFRAME,
+
+        # recording finalization
+        RECORDING_PROGRESS, RECORDING_FINALIZED,
+
+        # recording download
+        REQUEST_RECORDING_LIST, RECORDING_LIST, REQUEST_RECORDING,
+
+        # instant replay
+        REQUEST_REPLAY,
+
+        # time range of a recording file
+        REQUEST_RECORDING_SEGMENT, RECORDING_SEGMENT,
+
+        # participants speaking
+        ACTIVE_SPEAKERS,
+
+        # webcam always sent to a client
+        PIN_PARTICIPANT,
+
+        # background noise of a participant who went silent
+        COMFORT_NOISE,
+
+    ) = list(range(27))
+
+
+class BinaryType(Enum):
+    """Types of binary messages in server-client communication for chatroom"""
+    (
+        RECORDING_CHUNK, AUDIO, IMAGE, IMAGE_TILES,
+    ) = list(range(4))
+
+
+CHUNK_HEADER = struct.Struct("<BIQI")
+"""Header of a recording file chunk: binary type, recording ID, offset and CRC-32 of the chunk"""
+
+AUDIO_HEADER = struct.Struct("<BIdIBBIf")
+"""
+Header of an audio frame: binary type, ID of the sender (0 from a client), capture
+time, sample rate, number of channels, codec ID, number of frames and RMS level,
+the latter measured again by the server in the frames it forwards
+"""
+
+IMAGE_HEADER = struct.Struct("<BBHHHHH")
+"""
+Header of the changed tiles of a webcam image: binary type, whether all tiles are
+sent, number of rows and columns of tiles, height and width of the image, and
+number of tiles, each followed by a `TILE_HEADER` and its JPG data
+"""
+
+TILE_HEADER = struct.Struct("<HI")
+"""Header of a tile of a webcam image: index of the tile and size of its JPG data"""
+
+
+
+class ActiveSpeakers:
+    """
+    Ranks the participants of a chatroom by the smoothed level of their audio, and
+    keeps the loudest ones as the active speakers whose audio is forwarded. A
+    participant replaces an active speaker only if it is clearly louder, so that
+    the active speakers do not flap between participants talking equally loud.
+    """
+
+    SMOOTHING = .3
+    """Weight of the level of a new audio frame in the smoothed level"""
+    HYSTERESIS = 2.
+    """Ratio of levels a participant must exceed the quietest active speaker by to replace it"""
+    THRESHOLD = .006
+    """Smoothed RMS level (of samples in [-1, 1]) above which a participant is speaking, about -44 dBFS"""
+    TIMEOUT = .5
+    """Time (s) after its last audio frame a participant is taken as silent"""
+
+
+    def __init__(self, size: int = None):
+        self.size = size
+        """Number of active speakers, `None` for all participants, 0 for none"""
+        self.levels = {}
+        """Dict `{participant ID: float}` of the smoothed level of each participant"""
+        self.updated = {}
+        """Dict `{participant ID: float}` of the time of the last audio frame of each participant"""
+        self.active = []
+        """IDs of the active speakers"""
+        self.spoken = {}
+        """Dict `{participant ID: float}` of the time each participant last spoke"""
+
+
+    def level(self, participant_ID: int, now: float) -> float:
+        """Smoothed level of a participant, 0 if it has not sent audio lately"""
+        if now - self.updated.get(participant_ID, -np.inf) > ActiveSpeakers.TIMEOUT: return 0.
+        return self.levels[participant_ID]
+
+
+    @staticmethod
+    def rms(data: list | np.ndarray) -> float:
+        """RMS level of an audio frame, of samples in [-1, 1]"""
+        samples = np.asarray(data, dtype=np.float32)
+        return float(np.sqrt(np.mean(np.square(samples)))) if samples.size > 0 else 0.
+
+
+    def update(self, participant_ID: int, rms: float, *, now: float = None) -> bool:
+        """
+        Add the level of an audio frame of a participant to its smoothed level, and
+        rank it against the active speakers
+
+        Parameters
+        -----------
+        participant_ID: int
+
+        rms: float
+            RMS level of the audio frame, of samples in [-1, 1]
+
+        now: float, default = `None`
+            Time the frame is received at, the current time by default
+
+        Returns
+        ---------
+        Whether the participant is an active speaker, i.e. its audio is forwarded
+        """
+        if now is None: now = time.monotonic()
+
+        level = self.level(participant_ID, now)
+        self.levels[participant_ID] = level + ActiveSpeakers.SMOOTHING * (rms - level)
+        self.updated[participant_ID] = now
+        if self.levels[participant_ID] > ActiveSpeakers.THRESHOLD:
+            self.spoken[participant_ID] = now
+
+        if self.is_active(participant_ID): return True
+
+        if len(self.active) < self.size:
+            self.active.append(participant_ID)
+            return True
+
+        # no audio is forwarded with a size below 1
+        if len(self.active) == 0: return False
+
+        # replace the quietest active speaker only if clearly louder than it
+        level = self.levels[participant_ID]
+        quietest = min(self.active, key=lambda ID: self.level(ID, now))
+        if level > ActiveSpeakers.THRESHOLD and level > ActiveSpeakers.HYSTERESIS * self.level(quietest, now):
+            self.active[self.active.index(quietest)] = participant_ID
+            return True
+
+        return False
+
+
+    def is_active(self, participant_ID: int) -> bool:
+        """Whether the audio of a participant is forwarded"""
+        return self.size is None or participant_ID in self.active
+
+
+    def remove(self, participant_ID: int):
+        """Remove a participant who left the chatroom"""
+        self.levels.pop(participant_ID, None)
+        self.updated.pop(participant_ID, None)
+        self.spoken.pop(participant_ID, None)
+        if participant_ID in self.active: self.active.remove(participant_ID)
+
+
+    def speaking(self, *, now: float = None) -> list[int]:
+        """IDs of the active speakers who are speaking, loudest first"""
+        if now is None: now = time.monotonic()
+
+        candidates = self.levels if self.size is None else self.active
+        levels = {ID: level for ID in candidates if (level := self.level(ID, now)) > ActiveSpeakers.THRESHOLD}
+        return sorted(levels, key=levels.get, reverse=True)
+
+
+    def recent(self) -> list[int]:
+        """IDs of the participants who have spoken, the most recent first"""
+        return sorted(self.spoken, key=self.spoken.get, reverse=True)
 
 
 
 class ChatroomServer:
-    """Handles the server side of a chatroom."""
+    """
+    Handles the server side of a chatroom. Chatrooms are hosted by the worker
+    processes, which hand over the connections at the path of a chatroom.
+    """
 
     ID = 1
-    port = 8001
 
-
-    def __init__(self):
-        self.ID = ChatroomServer.ID
+    VIDEO_QUEUE_LIMIT = 1 << 16
+    """Bytes pending to a client above which webcam images are not sent to it"""
+    VIDEO_FEEDBACK_INTERVAL = 1.0
+    """Minimum period (s) between congestion feedbacks to a sender"""
+    DOWNLOAD_QUEUE_LIMIT = 1 << 14
+    """Bytes pending to a client above which recording chunks are not sent to it"""
+    SPEAKERS_INTERVAL = .2
+    """Minimum period (s) between broadcasts of the participants speaking"""
+
+
+    def __init__(self, *, ID: int = None, recording_format: str = RECORDING_FORMAT, audio_codec: str = AUDIO_CODEC):
+        if ID is None:
+            ID = ChatroomServer.ID
+            ChatroomServer.ID += 1
+        self.ID = ID
         """Chatroom ID"""
-        ChatroomServer.ID += 1
-
-        self.server = None
-        """Server connection of this chatroom server"""
 
-        self.port = ChatroomServer.port
-        """Port of chatroom server"""
-        ChatroomServer.port += 1
+        self.active = False
+        """Whether the chatroom accepts clients"""
+        self.audio_codec = audio_codec if audio_codec in AUDIO_CODECS else AUDIO_CODEC
+        """Name of the codec the clients encode their audio with, if they support it"""
 
         self.participant_data = {}
         """Dict `{ClientProtocol: ParticipantData}` containing all client connections and their status"""
@@ -84,41 +290,98 @@ class ChatroomServer:
         """Handles recording"""
         self.recording = False
         """Whether a recording has been started in this chatroom"""
+        self.recording_format = recording_format
+        """Encoding of the recordings of this chatroom, `"pcm"` or `"adpcm"`"""
+        self.finalize_tasks = set()
+        """Tasks finalizing stopped recordings"""
+        self.replay = None if RECORDING_REPLAY == 0 else ReplayBuffer(
+            60 * RECORDING_REPLAY, channels=self.recorder.channels, rate=self.recorder.rate)
+        """Keeps the latest audio of the chatroom, `None` if instant replay is disabled"""
+        self.recordings = {}
+        """Dict `{recording ID: (filename, path)}` of the recording files kept on the server"""
+        self.recording_ID = 1
+        """ID of the next recording file"""
+        self.segments = {}
+        """Dict `{(recording ID, start, end): recording ID}` of the segments exported from recording files"""
+        self.downloads = {}
+        """Dict `{ClientProtocol: set[Task]}` of the tasks sending recording files to each client"""
+        self.download_locks = {}
+        """Dict `{ClientProtocol: Lock}` so that recording files are sent to a client one at a time"""
+
+        self.video_drops = {}
+        """Dict `{ClientProtocol: int}` of webcam images of a sender not delivered to receivers"""
+        self.video_feedback_time = {}
+        """Dict `{ClientProtocol: float}` of the time of the last feedback to a sender"""
+        self.delivered_frames = {}
+        """Dict `{ClientProtocol: {participant ID: frame}}` of the latest webcam image sent to each client"""
+        self.pinned = {}
+        """Dict `{ClientProtocol: set[participant ID]}` of the participants whose webcam is always sent to each client"""
+
+        self.speakers = ActiveSpeakers(AUDIO_SPEAKERS)
+        """Ranks the participants by their audio level, only the active speakers are forwarded"""
+        self.speaking = []
+        """IDs of the participants speaking last broadcasted, loudest first"""
+        self.speaking_time = 0.
+        """Time of the last broadcast of the participants speaking"""
+        self.forwarded = set()
+        """IDs of the active speakers last checked, whose comfort noise is stopped once they are not"""
+        self.speakers_task = None
+        """Task broadcasting the participants speaking periodically, also when no audio arrives"""
 
 
     @property
     def started(self) -> bool:
         """Whether the server has started"""
-        return self.server is not None
+        return self.active
+
+
+    @property
+    def path(self) -> str:
+        """Path clients connect to the chatroom at"""
+        return ChatroomServer.chatroom_path(self.ID)
+
+
+    @staticmethod
+    def chatroom_path(ID: int) -> str:
+        """Path of a chatroom on the port of its worker"""
+        return f"/chatroom/{ID}"
+
+
+    @staticmethod
+    def chatroom_ID(path: str) -> int | None:
+        """ID of the chatroom at a path, `None` if it is not the path of a chatroom"""
+        prefix, _, ID = path.rpartition("/")
+        if prefix != "/chatroom" or not ID.isdigit(): return None
+        return int(ID)
 
 
     async def start(self):
         """
-        Start the chatroom server
+        Start the chatroom server, which only has to accept the connections handed
+        over to it
         """
-        try:
-            self.server = await websockets.serve(self.handler, host=HOST, port=self.port)
-        
-        except ConnectionRefusedError:
-            print(f"Cannot start chatroom server at port {HOST}:{self.port}")
-            return StatusType.ERROR
-
-        else:
-            print(f"Chatroom server {self.ID} started at port {HOST}:{self.port}")
-            return StatusType.OK
+        self.active = True
+        self.speakers_task = asyncio.create_task(self.update_speakers())
+        print(f"Chatroom server {self.ID} started at path {self.path}")
+        return StatusType.OK
         
 
     async def close(self):
         """
         Close the chatroom server
         """
-        if self.server is None: return StatusType.OK
+        if not self.active: return StatusType.OK
+        self.active = False
+        if self.speakers_task is not None: self.speakers_task.cancel()
+
+        await asyncio.gather(*(client.close() for client in list(self.participant_data)))
 
-        self.server.close()
-        await self.server.wait_closed()
+        # delete the recording files kept on the server
+        for _, path in self.recordings.values():
+            os.remove(path)
+        self.recordings = {}
 
-        print(f"Chatroom server at port {HOST}:{self.port} is closed")
-        self.server = None
+        print(f"Chatroom server {self.ID} is closed")
         return StatusType.OK
   
 
@@ -126,62 +389,143 @@ class ChatroomServer:
         """
         Handles events sent from chatroom clients
         """       
+        if not self.active: return
+
         try:
             async for message in websocket:
+                # encoded audio frame, or webcam image
+                if isinstance(message, bytes):
+                    if message[0] == BinaryType.AUDIO.value:
+                        await self.receive_audio_frame(websocket, message)
+                    elif message[0] in (BinaryType.IMAGE.value, BinaryType.IMAGE_TILES.value):
+                        await self.store_image(websocket, ChatroomServer.image_event(message))
+                        await self.send_video_feedback(websocket)
+                    await asyncio.sleep(0)
+                    continue
+
                 # read the message
                 event = json.loads(message)
                 event_type = EventType(event["type"])
 
                 match event_type:
-                    # send the client ID
+                    # send the client ID, and the codec of the audio it supports
                     case EventType.REQUEST_CLIENT_ID:
-                        await self.send_ID(websocket)
+                        await self.send_ID(websocket, event.get("request"), event.get("codecs", []))
 
                     # send the participant list
                     case EventType.REQUEST_PARTICIPANT_DATA:
-                        await self.send_participant_data(websocket)
+                        await self.send_participant_data(websocket, event.get("request"))
 
-                    # broadcast received data to all clients except the sender
+                    # broadcast received data to all clients except the sender, if
+                    # the sender is one of the active speakers
                     case EventType.CLIENT_AUDIO_DATA:
                         audio_data = event["data"]
-                        await self.broadcast_audio_data(audio_data, websocket)
+                        if self.speakers.update(self.participant_data[websocket].id, ActiveSpeakers.rms(audio_data)):
+                            await self.broadcast_audio_data(audio_data, websocket)
+                        self.broadcast_speaking()
                         if self.recording:
-                            self.recorder.record(audio_data) # Record the data
+                            # Record the data in the track of the sender
+                            self.recorder.record(
+                                self.participant_data[websocket].id, audio_data,
+                                timestamp=event.get("time"), rate=event.get("rate"), channels=event.get("channels"),
+                            )
+                        if self.replay is not None:
+                            self.replay.add(
+                                self.participant_data[websocket].id, audio_data,
+                                timestamp=event.get("time"), rate=event.get("rate"), channels=event.get("channels"),
+                            )
+
+                    # forward the background noise of a silent active speaker, played
+                    # by the clients in place of its audio
+                    case EventType.COMFORT_NOISE:
+                        if self.speakers.is_active(sender_ID := self.participant_data[websocket].id):
+                            websockets.broadcast(
+                                [c for c in self.participant_data if c is not websocket],
+                                json.dumps({**event, "ID": sender_ID}))
+                        self.broadcast_speaking()
 
                     # save client webcam image data, to be shown in GUI
                     case EventType.CLIENT_IMAGE_DATA:
-                        image_data = event["data"]
-                        self.participant_data[websocket].image = image_data
+                        await self.store_image(websocket, event)
+                        await self.send_video_feedback(websocket)
+
+                    # resend all tiles of a participant's webcam image to a client
+                    case EventType.REQUEST_KEYFRAME:
+                        self.delivered_frames.get(websocket, {}).pop(event["ID"], None)
 
                     # handle recording requests
                     case EventType.REQUEST_RECORDING_STATUS:
-                        await self.send_recording_status(websocket)
+                        await self.send_recording_status(websocket, event.get("request"))
 
                     case EventType.TOGGLE_RECORDING:
                         if not self.recording:
+                            self.recorder.start()
                             print("Recording started")
                         
                         else:
                             print("Recording stopped")
-                            # convert the recording data to wave file
-                            filename, filedata = self.recorder.convert_recording()
-                            # Broadcast the recording file
-                            await self.broadcast_recording(filename, filedata)
+                            # mix the recorded tracks and broadcast the files, without
+                            # holding up the events of this client
+                            if (recording := self.recorder.stop()) is not None:
+                                task = asyncio.create_task(self.finalize_recording(recording))
+                                self.finalize_tasks.add(task)
+                                task.add_done_callback(self.finalize_tasks.discard)
 
                         self.recording = not self.recording
                         
 
+                    # save the latest audio as a recording file
+                    case EventType.REQUEST_REPLAY:
+                        if self.replay is not None:
+                            task = asyncio.create_task(self.export_replay(event.get("length")))
+                            self.finalize_tasks.add(task)
+                            task.add_done_callback(self.finalize_tasks.discard)
+
+                    # export a time range of a recording file, for the client to download
+                    case EventType.REQUEST_RECORDING_SEGMENT:
+                        task = asyncio.create_task(self.send_recording_segment(
+                            websocket, event["ID"], event["start"], event["end"]))
+                        self.finalize_tasks.add(task)
+                        task.add_done_callback(self.finalize_tasks.discard)
+
+                    # send the list of recording files
+                    case EventType.REQUEST_RECORDING_LIST:
+                        await self.send_recording_list(websocket, event.get("request"))
+
+                    # send a recording file, from an offset to resume an interrupted download
+                    case EventType.REQUEST_RECORDING:
+                        task = asyncio.create_task(
+                            self.send_recording(websocket, event["ID"], event.get("offset", 0)))
+                        downloads = self.downloads.setdefault(websocket, set())
+                        downloads.add(task)
+                        task.add_done_callback(downloads.discard)
+
                     case EventType.TOGGLE_WEBCAM:
                         self.participant_data[websocket].webcam = \
                             not self.participant_data[websocket].webcam
+                        self.participant_data[websocket].image = None
+                        self.participant_data[websocket].tiles = None
 
                     case EventType.TOGGLE_MICROPHONE:
                         self.participant_data[websocket].microphone = \
                             not self.participant_data[websocket].microphone
+                        # a muted participant frees its place among the active speakers
+                        self.speakers.remove(self.participant_data[websocket].id)
+                        if not self.participant_data[websocket].microphone:
+                            self.stop_comfort_noise(self.participant_data[websocket].id)
+                        self.broadcast_speaking()
 
                     case EventType.TOGGLE_SPEAKER:
                         self.participant_data[websocket].speaker = \
                             not self.participant_data[websocket].speaker
+
+                    # always send, or stop always sending, a participant's webcam to the client
+                    case EventType.PIN_PARTICIPANT:
+                        pinned = self.pinned.setdefault(websocket, set())
+                        if event["pinned"]:
+                            pinned.add(event["ID"])
+                        else:
+                            pinned.discard(event["ID"])
                         
                 await asyncio.sleep(0)
 
@@ -192,26 +536,45 @@ class ChatroomServer:
 
         finally:
             # remove the client if disconnected
-            self.participant_data.pop(websocket, None)
+            if (p := self.participant_data.pop(websocket, None)) is not None:
+                self.speakers.remove(p.id)
+            self.video_drops.pop(websocket, None)
+            self.video_feedback_time.pop(websocket, None)
+            self.delivered_frames.pop(websocket, None)
+            self.pinned.pop(websocket, None)
+            self.download_locks.pop(websocket, None)
+            for task in self.downloads.pop(websocket, set()):
+                task.cancel()
 
             # if the chatroom becomes empty but a recording is ongoing, stop it
             if self.recording and len(self.participant_data) == 0:
                 self.recording = False
+                if (recording := self.recorder.stop()) is not None:
+                    recording.discard()
                 print("Recording stopped")
 
 
-    async def send_ID(self, client: websockets.WebSocketClientProtocol):
+    async def send_ID(self, client: websockets.WebSocketClientProtocol, request: int = None, codecs: list[str] = ()):
         """
-        Send the client ID to a client
+        Send the client ID to a client, with the codec its audio is encoded with
 
         Parameters:
         --------------
         client: `WebSocketClientProtocol`
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
+
+        codecs: list[str], default = `()`
+            Names of the codecs the client supports, the audio of a client supporting
+            none of them is sent unencoded
         """
 
         event = {
             "type": EventType.CLIENT_ID.value,
             "ID": self.CLIENT_ID,
+            "audio_codec": self.audio_codec if self.audio_codec in codecs else "float32",
+            "request": request,
         }
 
         # add the client to client list
@@ -222,32 +585,204 @@ class ChatroomServer:
         self.CLIENT_ID += 1
 
 
-    async def send_participant_data(self, client: websockets.WebSocketClientProtocol):
+    async def send_participant_data(self, client: websockets.WebSocketClientProtocol, request: int = None):
         """
         Send the participant list in chatroom to a client
         
         Parameters:
         --------------
         client: `WebSocketClientProtocol`
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
         """
+        # withhold webcam images from a client that cannot keep up, so that
+        # they do not delay the audio on the same connection
+        congested = self.queue_depth(client) > ChatroomServer.VIDEO_QUEUE_LIMIT
+
+        # only send webcam images the client has not received yet, the client keeps
+        # showing the last one otherwise
+        delivered = self.delivered_frames.setdefault(client, {})
+        video = self.video_senders(client)
+
+        participant_list = []
+        for sender, p in self.participant_data.items():
+            p_data = dict(p.__dict__)
+            p_data["image"] = p_data["tiles"] = None
+
+            # a placeholder is shown instead, all tiles are sent again once the
+            # webcam is resumed
+            if p.id not in video:
+                p_data["video"] = False
+                delivered.pop(p.id, None)
+
+            elif (p.image is None and p.tiles is None) or delivered.get(p.id) == p.frame:
+                pass
+
+            elif congested and sender is not client:
+                self.video_drops[sender] = self.video_drops.get(sender, 0) + 1
+
+            else:
+                # send the tiles updated since the image the client last received,
+                # i.e. all tiles if it has not received any
+                if p.tiles is not None:
+                    since = delivered.get(p.id, 0)
+                    p_data["tiles"] = [
+                        [i, data] for i, (frame, data) in enumerate(p.tiles)
+                        if frame > since and data is not None
+                    ]
+                else:
+                    p_data["image"] = p.image
+
+                delivered[p.id] = p.frame
+
+            participant_list.append(p_data)
+
         event = {
             "type": EventType.PARTICIPANT_DATA.value,
-            "list": [p.__dict__ for p in self.participant_data.values()]
+            "list": participant_list,
+            "request": request,
         }
         await client.send(json.dumps(event))
 
 
-    async def send_recording_status(self, client: websockets.WebSocketClientProtocol):
+    def video_senders(self, client: websockets.WebSocketClientProtocol) -> set[int]:
+        """
+        IDs of the participants whose webcam images are sent to a client: the
+        client itself, the participants it pinned, and the `VIDEO_LAST_N` who spoke
+        most recently among the others with webcam on
+
+        Parameters:
+        --------------
+        client: `WebSocketClientProtocol`
+        """
+        if VIDEO_LAST_N is None: return {p.id for p in self.participant_data.values()}
+
+        own = {self.participant_data[client].id} if client in self.participant_data else set()
+        pinned = self.pinned.get(client, set())
+
+        # the participants who have not spoken follow, in the order they joined
+        recent = {ID: i for i, ID in enumerate(self.speakers.recent())}
+        webcams = [p.id for p in self.participant_data.values() if p.webcam and p.id not in own | pinned]
+        webcams.sort(key=lambda ID: recent.get(ID, len(recent)))
+
+        return own | pinned | set(webcams[:VIDEO_LAST_N])
+
+
+    @staticmethod
+    def image_event(message: bytes) -> dict:
+        """
+        Convert a binary webcam image into the `CLIENT_IMAGE_DATA` event it replaces,
+        with the JPG data as lists to be sent on to the clients
+
+        Parameters
+        -----------
+        message: bytes
+            Binary message of type `IMAGE`, followed by the JPG data, or `IMAGE_TILES`,
+            with an `IMAGE_HEADER`
+        """
+        if message[0] == BinaryType.IMAGE.value:
+            return {"type": EventType.CLIENT_IMAGE_DATA.value, "data": list(message[1:])}
+
+        _, keyframe, rows, cols, height, width, n_tiles = IMAGE_HEADER.unpack_from(message)
+        tiles, offset = [], IMAGE_HEADER.size
+        for _ in range(n_tiles):
+            i, size = TILE_HEADER.unpack_from(message, offset)
+            offset += TILE_HEADER.size
+            tiles.append([i, list(message[offset : offset + size])])
+            offset += size
+
+        return {
+            "type": EventType.CLIENT_IMAGE_DATA.value,
+            "tiles": tiles,
+            "grid": [rows, cols],
+            "size": [height, width],
+            "keyframe": bool(keyframe),
+        }
+
+
+    async def store_image(self, sender: websockets.WebSocketClientProtocol, event: dict):
+        """
+        Store the webcam image received from a client, either a full image or the
+        tiles that changed
+
+        Parameters:
+        --------------
+        sender: `WebSocketClientProtocol`
+
+        event: dict
+            `CLIENT_IMAGE_DATA` event received
+        """
+        p = self.participant_data[sender]
+
+        if "tiles" not in event:
+            p.frame += 1
+            p.image = event["data"]
+            p.tiles = None
+            return
+
+        # changed tiles cannot be applied without all tiles, ask the sender for them
+        if not event["keyframe"] and (p.tiles is None or p.size != event["size"]):
+            await sender.send(json.dumps({"type": EventType.REQUEST_KEYFRAME.value}))
+            return
+
+        p.frame += 1
+        if event["keyframe"]:
+            rows, cols = event["grid"]
+            p.image = None
+            p.tiles = [[p.frame, None] for _ in range(rows * cols)]
+            p.grid = event["grid"]
+            p.size = event["size"]
+
+        for i, data in event["tiles"]:
+            p.tiles[i] = [p.frame, data]
+
+
+    async def send_video_feedback(self, sender: websockets.WebSocketClientProtocol):
+        """
+        Report to a sender of webcam images how well the receivers keep up, at
+        most once per `VIDEO_FEEDBACK_INTERVAL`
+
+        Parameters:
+        --------------
+        sender: `WebSocketClientProtocol`
+        """
+        now = time.monotonic()
+        if now - self.video_feedback_time.get(sender, 0) < ChatroomServer.VIDEO_FEEDBACK_INTERVAL:
+            return
+        self.video_feedback_time[sender] = now
+
+        receivers = [c for c in self.participant_data if c is not sender]
+        event = {
+            "type": EventType.VIDEO_FEEDBACK.value,
+            "queue_depth": max((self.queue_depth(c) for c in receivers), default=0),
+            "drops": self.video_drops.pop(sender, 0),
+        }
+        await sender.send(json.dumps(event))
+
+
+    @staticmethod
+    def queue_depth(client: websockets.WebSocketClientProtocol) -> int:
+        """Number of bytes pending in the write buffer of a client connection"""
+        if client.transport is None: return 0
+        return client.transport.get_write_buffer_size()
+
+
+    async def send_recording_status(self, client: websockets.WebSocketClientProtocol, request: int = None):
         """
         Send the recording status in the chatroom to a client
         
         Parameters:
         --------------
         client: `WebSocketClientProtocol`
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
         """
         event = {
             "type": EventType.RECORDING_STATUS.value,
             "status": self.recording,
+            "request": request,
         }
         await client.send(json.dumps(event))
 
@@ -267,6 +802,7 @@ class ChatroomServer:
         event = {
             "type": EventType.BROADCAST_AUDIO_DATA.value,
             "data": data,
+            "ID": self.participant_data[sender].id,
         }
 
         clients = list(self.participant_data)
@@ -276,33 +812,330 @@ class ChatroomServer:
         websockets.broadcast(clients, json.dumps(event))
 
 
-    async def broadcast_recording(self, filename: str, filedata: str):
+    async def receive_audio_frame(self, sender: websockets.WebSocketClientProtocol, message: bytes):
+        """
+        Forward an encoded audio frame to all clients except the sender, if the
+        sender is one of the active speakers, ranked by the level of the frame. The
+        frame is only decoded to be recorded.
+
+        Parameters
+        -----------
+        sender: `WebSocketClientProtocol`
+
+        message: bytes
+            Binary message with an `AUDIO_HEADER`, followed by the encoded audio
+        """
+        _, _, timestamp, rate, channels, codec_ID, frames, _ = AUDIO_HEADER.unpack_from(message)
+        if (codec := AUDIO_CODEC_IDS.get(codec_ID)) is None: return
+        participant_ID = self.participant_data[sender].id
+        payload = message[AUDIO_HEADER.size:]
+
+        # the level in the header is the sender's own claim, the speakers are ranked
+        # by the level of the audio actually sent
+        recorded = self.recording or self.replay is not None
+        try:
+            data = codec.decode(payload, frames, channels) if recorded else None
+            level = ActiveSpeakers.rms(data) if recorded else codec.level(payload, frames, channels)
+        except ValueError:
+            return
+
+        if self.speakers.update(participant_ID, level):
+            header = AUDIO_HEADER.pack(
+                BinaryType.AUDIO.value, participant_ID, timestamp, rate, channels, codec_ID, frames, level)
+            clients = [c for c in self.participant_data if c is not sender]
+            websockets.broadcast(clients, header + payload)
+        self.broadcast_speaking()
+
+        if not recorded: return
+
+        if self.recording:
+            self.recorder.record(participant_ID, data, timestamp=timestamp, rate=rate, channels=channels)
+        if self.replay is not None:
+            self.replay.add(participant_ID, data, timestamp=timestamp, rate=rate, channels=channels)
+
+
+    def broadcast_speaking(self):
         """
-        Broadcasts the recording file to all users. Since the file size is too large,
-        it is to be sent through different chunks.
+        Broadcast the participants speaking to all clients when they change, and stop
+        the comfort noise of the participants no longer forwarded
         """
-        assert isinstance(filedata, str)
+        # the audio of a participant who lost its place is no longer forwarded
+        if self.speakers.size is not None:
+            forwarded = set(self.speakers.active)
+            for ID in self.forwarded - forwarded:
+                self.stop_comfort_noise(ID)
+            self.forwarded = forwarded
 
-        CHUNK_SIZE = 1 << 19
-        n_chunks = ceil(len(filedata) / CHUNK_SIZE)
+        # a change within the interval is broadcasted on the next tick of `update_speakers`
+        now = time.monotonic()
+        if now - self.speaking_time < ChatroomServer.SPEAKERS_INTERVAL: return
+        if (speaking := self.speakers.speaking(now=now)) == self.speaking: return
+
+        self.speaking = speaking
+        self.speaking_time = now
 
         event = {
-            "type": EventType.RECORDING_FILE.value,
+            "type": EventType.ACTIVE_SPEAKERS.value,
+            "list": speaking,
+        }
+        websockets.broadcast(list(self.participant_data), json.dumps(event))
+
+
+    def stop_comfort_noise(self, participant_ID: int):
+        """Tell the other clients to stop the comfort noise of a participant"""
+        event = {"type": EventType.COMFORT_NOISE.value, "ID": participant_ID, "level": 0.}
+        websockets.broadcast(
+            [c for c, p in self.participant_data.items() if p.id != participant_ID],
+            json.dumps(event))
+
+
+    async def update_speakers(self):
+        """
+        Broadcast the participants speaking periodically, as the speakers who went
+        silent send no audio that would update them
+        """
+        while True:
+            await asyncio.sleep(ChatroomServer.SPEAKERS_INTERVAL)
+            self.broadcast_speaking()
+
+
+    async def finalize_recording(self, recording: Recording):
+        """
+        Finalize a stopped recording in a worker thread, so that the chatroom keeps
+        forwarding audio meanwhile. Progress and completion are broadcasted to all
+        clients.
+
+        Parameters
+        -----------
+        recording: Recording
+            The stopped recording
+        """
+        loop = asyncio.get_running_loop()
+
+        def progress(fraction: float):
+            loop.call_soon_threadsafe(self.broadcast_recording_progress, recording.filename, fraction)
+
+        try:
+            outputs = await loop.run_in_executor(None, partial(
+                recording.finalize, format=self.recording_format, progress=progress))
+
+        except Exception as e:
+            print(f"Failed to finalize recording {recording.filename}:", e)
+            return
+
+        # keep the files on the server, for the clients to download on demand
+        for filename, path in outputs:
+            self.recordings[self.recording_ID] = (filename, path)
+            self.recording_ID += 1
+
+        event = {
+            "type": EventType.RECORDING_FINALIZED.value,
+            "filename": recording.filename,
+        }
+        websockets.broadcast(list(self.participant_data), json.dumps(event))
+        await self.broadcast_recording_list()
+
+
+    async def export_replay(self, length: float = None):
+        """
+        Save the latest audio of the chatroom as a recording file and broadcast it
+        to all clients. The audio is copied at once, and written in a worker thread.
+
+        Parameters
+        -----------
+        length: float, default = `None`
+            Length (s) of the audio, all the audio kept if not given
+        """
+        data = self.replay.clip(length)
+        if len(data) == 0: return
+
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        filename = os.path.join('recording', datetime.datetime.now().strftime('replay%Y%m%d%H%M%S.wav'))
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, partial(
+                self.replay.export, path, data, format=self.recording_format))
+
+        except Exception as e:
+            print(f"Failed to save replay {filename}:", e)
+            os.remove(path)
+            return
+
+        self.recordings[self.recording_ID] = (filename, path)
+        self.recording_ID += 1
+        await self.broadcast_recording_list()
+
+
+    def broadcast_recording_progress(self, filename: str, progress: float):
+        """
+        Broadcast the progress of finalizing a recording to all clients
+
+        Parameters
+        -----------
+        filename: str
+            Filename of the recording
+
+        progress: float
+            Fraction of the recording finalized
+        """
+        event = {
+            "type": EventType.RECORDING_PROGRESS.value,
             "filename": filename,
-            "filedata": None,
-            "chunk": None,
+            "progress": progress,
         }
+        websockets.broadcast(list(self.participant_data), json.dumps(event))
 
-        for i in range(n_chunks):
-            event["filedata"] = filedata[: CHUNK_SIZE + 1]
-            event["chunk"] = (i+1, n_chunks)
 
-            filedata = filedata[CHUNK_SIZE + 1 :]
-            
-            websockets.broadcast(list(self.participant_data), json.dumps(event))
+    def recording_list(self) -> list[dict]:
+        """ID, filename, size and duration of each recording file kept on the server"""
+        return [
+            {
+                "ID": recording_ID, "filename": filename,
+                "size": os.path.getsize(path), "duration": WavIndex(path).duration,
+            }
+            for recording_ID, (filename, path) in self.recordings.items()
+        ]
+
+
+    async def send_recording_segment(self, client: websockets.WebSocketClientProtocol,
+                                     recording_ID: int, start: float, end: float):
+        """
+        Export a time range of a recording file as a new recording file in a worker
+        thread, reading only that range, and send its ID to the client to download
+
+        Parameters
+        -----------
+        client: `WebSocketClientProtocol`
+
+        recording_ID: int
+            ID of the recording file
+
+        start: float
+            Start time (s) of the range
+
+        end: float
+            End time (s) of the range
+        """
+        if recording_ID not in self.recordings: return
+
+        if (segment_ID := self.segments.get((recording_ID, start, end))) is None:
+            filename, path = self.recordings[recording_ID]
+            fd, segment_path = tempfile.mkstemp(suffix='.wav')
+            os.close(fd)
+
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: WavIndex(path).export(segment_path, start, end))
+
+            except Exception as e:
+                print(f"Failed to export segment of recording {filename}:", e)
+                os.remove(segment_path)
+                return
+
+            segment_ID = self.recording_ID
+            self.recording_ID += 1
+            self.recordings[segment_ID] = (filename.replace('.wav', f'_{start:g}-{end:g}s.wav'), segment_path)
+            self.segments[(recording_ID, start, end)] = segment_ID
+
+        segment_filename, segment_path = self.recordings[segment_ID]
+        event = {
+            "type": EventType.RECORDING_SEGMENT.value,
+            "ID": segment_ID,
+            "filename": segment_filename,
+            "size": os.path.getsize(segment_path),
+        }
+        try:
+            await client.send(json.dumps(event))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+    async def send_recording_list(self, client: websockets.WebSocketClientProtocol, request: int = None):
+        """
+        Send the list of recording files to a client
+        
+        Parameters:
+        --------------
+        client: `WebSocketClientProtocol`
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
+        """
+        event = {
+            "type": EventType.RECORDING_LIST.value,
+            "list": self.recording_list(),
+            "request": request,
+        }
+        await client.send(json.dumps(event))
+
+
+    async def broadcast_recording_list(self):
+        """Broadcast the list of recording files to all clients"""
+        event = {
+            "type": EventType.RECORDING_LIST.value,
+            "list": self.recording_list(),
+        }
+        websockets.broadcast(list(self.participant_data), json.dumps(event))
+
+
+    async def send_recording(self, client: websockets.WebSocketClientProtocol, recording_ID: int, offset: int = 0):
+        """
+        Send a recording file to a client as binary chunks, read from a memory map
+        of the file. The chunks are only sent while nothing else is pending to the
+        client, and at most at `RECORDING_DOWNLOAD_RATE`, so that the download does
+        not delay live audio and video.
+
+        Parameters
+        -----------
+        client: `WebSocketClientProtocol`
+
+        recording_ID: int
+            ID of the recording file
+
+        offset: int, default = 0
+            Offset in bytes to start sending from
+        """
+        CHUNK_SIZE = 1 << 16
+
+        if (recording := self.recordings.get(recording_ID)) is None: return
+        filename, path = recording
+
+        loop = asyncio.get_running_loop()
+
+        async with self.download_locks.setdefault(client, asyncio.Lock()):
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                size = len(m)
+
+                event = {
+                    "type": EventType.RECORDING_FILE.value,
+                    "ID": recording_ID,
+                    "filename": filename,
+                    "size": size,
+                    "offset": offset,
+                }
+                await client.send(json.dumps(event))
 
+                start_time, sent = loop.time(), 0
 
-        print(f"Broadcasted recording file {filename}")
+                with memoryview(m) as filedata:
+                    for chunk_offset in range(offset, size, CHUNK_SIZE):
+                        # wait for anything pending to the client to be sent
+                        while self.queue_depth(client) > ChatroomServer.DOWNLOAD_QUEUE_LIMIT:
+                            await asyncio.sleep(.01)
+
+                        # limit the bandwidth of the download
+                        if (delay := start_time + sent / RECORDING_DOWNLOAD_RATE - loop.time()) > 0:
+                            await asyncio.sleep(delay)
+
+                        chunk = filedata[chunk_offset : chunk_offset + CHUNK_SIZE]
+                        header = CHUNK_HEADER.pack(
+                            BinaryType.RECORDING_CHUNK.value, recording_ID, chunk_offset, zlib.crc32(chunk))
+                        await client.send(header + chunk)
+                        sent += len(chunk)
+                        chunk.release()
+
+        print(f"Sent recording file {filename}")
 
 
 
@@ -314,14 +1147,25 @@ class ChatroomClient:
         """Client ID in a chatroom"""
         self.connection = None
         """Connection to a chatroom server"""
+        self.host = None
+        """IP address of connected chatroom server"""
         self.port = None
         """Port of connected chatroom server"""
+        self.audio_codec = AUDIO_CODECS["float32"]
+        """Codec the audio is encoded with, chosen by the chatroom server"""
 
         self.user = user
         """The end user who this client belong to"""
 
-        self.recording_file_data = ""
-        """Recording file buffer"""
+        self.recording_files = {}
+        """Dict `{recording ID: RecordingFile}` of recording files being downloaded"""
+        self.recording_writer = ThreadPoolExecutor(max_workers=1)
+        """Writes the recording files in order, away from the event loop"""
+
+        self.requests = {}
+        """Dict `{request ID: Future}` of the requests waiting for the reply of the server"""
+        self.next_request = 0
+        """ID of the next request"""
 
 
     @property
@@ -330,29 +1174,33 @@ class ChatroomClient:
         return self.connection is not None
 
 
-    async def connect(self, port: int, ID: int):
+    async def connect(self, host: str, port: int, ID: int):
         """
         Connect to a chatroom server
 
         Parameters
         ------------
+        host: str
+            IP address the chatroom server is hosted at
+
         port: int
-            Port of the chatroom server
+            Port the chatroom server is hosted on
 
         ID: int
             ID of the chatroom server
         """
         try:
-            self.connection = await websockets.connect(f"ws://{HOST}:{port}")
+            self.connection = await websockets.connect(f"ws://{host}:{port}{ChatroomServer.chatroom_path(ID)}")
 
-        except ConnectionRefusedError:
-            print(f"Cannot connect to chatroom server {ID} at port {HOST}:{port}")
+        except (ConnectionRefusedError, websockets.exceptions.InvalidStatusCode):
+            print(f"Cannot connect to chatroom server {ID} at port {host}:{port}")
             return StatusType.ERROR
 
         else:
             await self.request_ID()
-            print(f"Connected to chatroom server {ID} at port {HOST}:{port}")
+            print(f"Connected to chatroom server {ID} at port {host}:{port}")
             self.user.chatroom_ID = ID
+            self.host = host
             self.port = port                
             return StatusType.OK
 
@@ -366,12 +1214,25 @@ class ChatroomClient:
         await self.connection.close()
 
         if self.port is not None:
-            print(f"Connection to chatroom server at port {HOST}:{self.port} is closed")
+            print(f"Connection to chatroom server at port {self.host}:{self.port} is closed")
         
         self.connection = None
+        self.host = None
         self.port = None
         self.user.chatroom_ID = None
         self.ID = None
+        self.audio_codec = AUDIO_CODECS["float32"]
+
+        # no reply will come for the pending requests
+        for future in self.requests.values():
+            if not future.done(): future.set_result(None)
+        self.requests = {}
+
+        # keep incomplete recording files, to be resumed
+        for recording_file in self.recording_files.values():
+            if recording_file is not None:
+                recording_file.close().add_done_callback(ChatroomClient.report_recording_file)
+        self.recording_files = {}
 
         return StatusType.OK
        
@@ -383,6 +1244,15 @@ class ChatroomClient:
         while self.connected:
             try:
                 async for message in self.connection:
+                    # audio frame of another client, or chunk of a recording file
+                    if isinstance(message, bytes):
+                        if message[0] == BinaryType.AUDIO.value:
+                            await self.receive_audio_frame(message)
+                        else:
+                            await self.receive_recording_chunk(message)
+                        await asyncio.sleep(0)
+                        continue
+
                     event = json.loads(message)
                     event_type = EventType(event["type"])
 
@@ -390,11 +1260,16 @@ class ChatroomClient:
                         # set client ID
                         case EventType.CLIENT_ID:
                             self.ID = event["ID"]
+                            self.audio_codec = AUDIO_CODECS[event.get("audio_codec", "float32")]
 
                         # play the audio data from other clients
                         case EventType.BROADCAST_AUDIO_DATA:
                             data = event["data"]
-                            await self.user.play(data)
+                            await self.user.play(data, event.get("ID"))
+
+                        # play noise while a participant is silent
+                        case EventType.COMFORT_NOISE:
+                            self.user.receive_comfort_noise(event["ID"], event["level"])
 
                         # get participant list
                         case EventType.PARTICIPANT_DATA:
@@ -405,39 +1280,64 @@ class ChatroomClient:
                         case EventType.RECORDING_STATUS:
                             self.user.recording_status = event["status"]
 
-                        # save the recording file locally
+                        # get progress of finalizing a recording
+                        case EventType.RECORDING_PROGRESS:
+                            self.user.recording_progress = event["progress"]
+
+                        case EventType.RECORDING_FINALIZED:
+                            self.user.recording_progress = None
+
+                        # adapt the webcam stream to the receivers
+                        case EventType.VIDEO_FEEDBACK:
+                            self.user.rate_controller.feedback(event["queue_depth"], event["drops"])
+
+                        # send all tiles with the next webcam image
+                        case EventType.REQUEST_KEYFRAME:
+                            self.user.tile_encoder.reset()
+
+                        # get the list of recording files available for download
+                        case EventType.RECORDING_LIST:
+                            self.user.recordings = event["list"]
+
+                        # a recording file starts being sent
                         case EventType.RECORDING_FILE:
-                            self.recording_file_data += event["filedata"]
-                            
-                            # if all chunks have been received, write to file
-                            current_chunk, total_chunk = event["chunk"]
-                            if current_chunk == total_chunk:
-                                await self.save_recording(event["filename"], self.recording_file_data)
-                                self.recording_file_data = ""
+                            print(f"Downloading recording file {event['filename']} "
+                                  f"from {event['offset']}/{event['size']} bytes")
 
+                        # download a requested segment of a recording file
+                        case EventType.RECORDING_SEGMENT:
+                            await self.request_recording(event["ID"], event["filename"], event["size"])
+
+                        # get the participants speaking
+                        case EventType.ACTIVE_SPEAKERS:
+                            self.user.active_speakers = event["list"]
+
+                    # wake the request replied to, after the reply is applied
+                    self.resolve(event)
                     await asyncio.sleep(0)
                 
             except websockets.exceptions.ConnectionClosed:
                 break
 
             else:
-                await asyncio.sleep(0)
+                # the chatroom server closed the connection
+                break
 
 
         if self.port is not None:
-            print(f"Failed to receive event from chatroom server at port {HOST}:{self.port}")
+            print(f"Failed to receive event from chatroom server at port {self.host}:{self.port}")
 
         await self.disconnect()
 
 
-    async def send(self, event: dict):
-        """Handle data sending to the chatroom server"""
+    async def send(self, event: dict | bytes):
+        """Handle data sending to the chatroom server, of an event or a binary message"""
         try:
-            await self.connection.send(json.dumps(event))
+            await self.connection.send(event if isinstance(event, bytes) else json.dumps(event))
 
         except websockets.exceptions.ConnectionClosed:
             if self.port is not None:
-                print(f"Failed to send event to chatroom server at port {HOST}:{self.port}")  
+                print(f"Failed to send event to chatroom server at port {self.host}:{self.port}")  
             
             return StatusType.ERROR
         
@@ -449,65 +1349,216 @@ class ChatroomClient:
             return StatusType.OK
 
 
-    async def send_audio_data(self, data: list):
+    async def request(self, event: dict) -> dict | None:
         """
-        Send audio data to the chatroom server
+        Send a request to the chatroom server, and wait for its reply
 
         Parameters
         -----------
-        data: list
-            Audio data to be sent to the server
+        event: dict
+            Request to be sent, tagged with an ID the server sends back in its reply
+
+        Returns
+        ---------
+        Reply of the server, `None` if no reply comes within `REQUEST_TIMEOUT`
         """
-        assert isinstance(data, list)
+        request_ID = self.next_request
+        self.next_request += 1
+        future = self.requests[request_ID] = asyncio.get_running_loop().create_future()
 
-        event = {
-            "type": EventType.CLIENT_AUDIO_DATA.value,
-            "data": data,
-        }
-        return await self.send(event)
-    
+        try:
+            if (await self.send({**event, "request": request_ID})) == StatusType.ERROR:
+                return None
+
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            print(f"No reply to {EventType(event['type']).name} from chatroom server at port {self.host}:{self.port}")
+            return None
+
+        finally:
+            self.requests.pop(request_ID, None)
+
+
+    def resolve(self, event: dict):
+        """Pass an event received to the request it replies to, if any"""
+        if (future := self.requests.get(event.get("request"))) is not None and not future.done():
+            future.set_result(event)
+
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of bytes pending in the write buffer of the connection"""
+        if not self.connected or self.connection.transport is None: return 0
+        return self.connection.transport.get_write_buffer_size()
 
-    async def send_image_data(self, data: list):
+
+    async def send_audio_frame(self, data: np.ndarray, *, timestamp: float, rate: int):
         """
-        Send webcam image data to the chatroom server
+        Send audio data to the chatroom server, encoded with the codec of the
+        chatroom in a binary audio frame
 
         Parameters
         -----------
-        data: list
-            Image data to be sent to the server. Represented as a 1D list in JPG format.
+        data: np.ndarray
+            Float samples in [-1, 1] of shape (frames, channels)
+
+        timestamp: float
+            Time the audio data was captured at
+
+        rate: int
+            Sample rate of the audio data
+        """
+        frames, channels = data.shape
+        header = AUDIO_HEADER.pack(
+            BinaryType.AUDIO.value, 0, timestamp, rate, channels, self.audio_codec.ID, frames, ActiveSpeakers.rms(data))
+        return await self.send(header + self.audio_codec.encode(data))
+
+
+    async def receive_audio_frame(self, message: bytes):
+        """
+        Decode an audio frame of another client received from the chatroom server,
+        and play it
+
+        Parameters
+        -----------
+        message: bytes
+            Binary message with an `AUDIO_HEADER`, followed by the encoded audio
+        """
+        _, participant_ID, _, _, channels, codec_ID, frames, _ = AUDIO_HEADER.unpack_from(message)
+        if (codec := AUDIO_CODEC_IDS.get(codec_ID)) is None: return
+
+        data = codec.decode(message[AUDIO_HEADER.size:], frames, channels)
+        await self.user.play(data, participant_ID)
+
+
+    async def send_comfort_noise(self, level: float, *, timestamp: float):
         """
-        assert isinstance(data, list)
+        Send the background noise level of the user, while the audio is withheld
+        for being silent, to the chatroom server
 
+        Parameters
+        -----------
+        level: float
+            RMS level of the background noise, of samples in [-1, 1]
+
+        timestamp: float
+            Time the silent audio was captured at
+        """
         event = {
-            "type": EventType.CLIENT_IMAGE_DATA.value,
-            "data": data,
+            "type": EventType.COMFORT_NOISE.value,
+            "level": level,
+            "time": timestamp,
         }
         return await self.send(event)
 
 
+    async def send_image_data(self, data: np.ndarray):
+        """
+        Send webcam image data to the chatroom server, in a binary message
+
+        Parameters
+        -----------
+        data: np.ndarray
+            Image data to be sent to the server, in JPG format
+        """
+        return await self.send(bytes([BinaryType.IMAGE.value]) + data.tobytes())
+
+
+    async def send_image_tiles(self, tiles: list, *, grid: tuple[int, int], size: tuple[int, int], keyframe: bool):
+        """
+        Send the changed tiles of a webcam image to the chatroom server, in a binary
+        message
+
+        Parameters
+        -----------
+        tiles: list[tuple[int, np.ndarray]]
+            Index of each tile and its data in JPG format
+
+        grid: tuple[int, int]
+            Number of rows and columns of tiles
+
+        size: tuple[int, int]
+            Height and width of the image
+
+        keyframe: bool
+            Whether all tiles of the image are sent
+        """
+        assert isinstance(tiles, list)
+
+        message = [IMAGE_HEADER.pack(BinaryType.IMAGE_TILES.value, keyframe, *grid, *size, len(tiles))]
+        for i, data in tiles:
+            message += [TILE_HEADER.pack(i, data.nbytes), data.tobytes()]
+        return await self.send(b"".join(message))
+
+
     async def request_ID(self):
         """
         Send a request for the client ID in a chatroom to the chatroom server
         """
         event = {
             "type": EventType.REQUEST_CLIENT_ID.value,
+            "codecs": list(AUDIO_CODECS),
         }
         return await self.send(event)
 
 
-    async def request_participant_data(self):
-        """Send a request for the list of participants to the chatroom server"""
+    async def request_participant_data(self) -> dict | None:
+        """
+        Request the list of participants from the chatroom server, and wait until
+        it is received
+
+        Returns
+        ---------
+        `PARTICIPANT_DATA` event replied, `None` if failed
+        """
         event = {
             "type": EventType.REQUEST_PARTICIPANT_DATA.value,
         }
+        return await self.request(event)
+
+
+    async def request_keyframe(self, participant_ID: int):
+        """Request all tiles of a participant's webcam image from the chatroom server"""
+        event = {
+            "type": EventType.REQUEST_KEYFRAME.value,
+            "ID": participant_ID,
+        }
         return await self.send(event)
         
 
-    async def request_recording_status(self):
-        """Request recording status from the chatroom server"""
+    async def request_recording_status(self) -> dict | None:
+        """
+        Request recording status from the chatroom server, and wait until it is
+        received
+
+        Returns
+        ---------
+        `RECORDING_STATUS` event replied, `None` if failed
+        """
         event = {
             "type": EventType.REQUEST_RECORDING_STATUS.value,
         }
+        return await self.request(event)
+
+
+    async def pin_participant(self, participant_ID: int, pinned: bool):
+        """
+        Send a request of always sending, or no longer, a participant's webcam
+        images to the chatroom server
+
+        Parameters
+        ------------
+        participant_ID: int
+
+        pinned: bool
+            Whether the webcam images are always sent
+        """
+        event = {
+            "type": EventType.PIN_PARTICIPANT.value,
+            "ID": participant_ID,
+            "pinned": pinned,
+        }
         return await self.send(event)
 
 
@@ -543,11 +1594,139 @@ class ChatroomClient:
         return await self.send(event)
     
 
-    async def save_recording(self, filename: str, filedata: str):
+    async def request_replay(self, length: float = None):
         """
-        Save the recording file received from the chatroom server
+        Request the chatroom server to save its latest audio as a recording file
+
+        Parameters
+        -----------
+        length: float, default = `None`
+            Length (s) of the audio, all the audio kept by the server if not given
         """
-        assert isinstance(filedata, str)
+        event = {
+            "type": EventType.REQUEST_REPLAY.value,
+            "length": length,
+        }
+        return await self.send(event)
+
 
-        Recorder.save_recording(filename, filedata)
+    async def request_recording_list(self):
+        """Request the list of recording files from the chatroom server"""
+        event = {
+            "type": EventType.REQUEST_RECORDING_LIST.value,
+        }
+        return await self.send(event)
+
+
+    async def request_recording_segment(self, recording_ID: int, start: float, end: float):
+        """
+        Request a time range of a recording file from the chatroom server, which is
+        downloaded once exported
+
+        Parameters
+        -----------
+        recording_ID: int
+            ID of the recording file
+
+        start: float
+            Start time (s) of the range
+
+        end: float
+            End time (s) of the range
+        """
+        event = {
+            "type": EventType.REQUEST_RECORDING_SEGMENT.value,
+            "ID": recording_ID,
+            "start": start,
+            "end": end,
+        }
+        return await self.send(event)
+
+
+    async def request_recording(self, recording_ID: int, filename: str, size: int):
+        """
+        Request a recording file from the chatroom server, resuming any incomplete
+        download of it
+
+        Parameters
+        -----------
+        recording_ID: int
+            ID of the recording file
+
+        filename: str
+            Filename to save the recording file as
+
+        size: int
+            Size of the recording file in bytes
+        """
+        if recording_ID in self.recording_files: return StatusType.OK
+
+        # opened in the writer, after any earlier operation on the same file
+        self.recording_files[recording_ID] = None
+        try:
+            recording_file = await asyncio.get_running_loop().run_in_executor(
+                self.recording_writer, partial(RecordingFile, filename, size, writer=self.recording_writer))
+
+        except Exception as e:
+            print(f"Cannot save recording file {filename}:", e)
+            self.recording_files.pop(recording_ID, None)
+            return StatusType.ERROR
+
+        if recording_ID not in self.recording_files:
+            # disconnected meanwhile
+            recording_file.close()
+            return StatusType.ERROR
+
+        if recording_file.complete:
+            self.recording_files.pop(recording_ID)
+            recording_file.close().add_done_callback(ChatroomClient.report_recording_file)
+            return StatusType.OK
+
+        self.recording_files[recording_ID] = recording_file
+
+        event = {
+            "type": EventType.REQUEST_RECORDING.value,
+            "ID": recording_ID,
+            "offset": recording_file.received,
+        }
+        return await self.send(event)
+
+
+    async def receive_recording_chunk(self, message: bytes):
+        """
+        Write a chunk of a recording file received from the chatroom server to disk
+
+        Parameters
+        -----------
+        message: bytes
+            Binary message with a `CHUNK_HEADER`, followed by the chunk
+        """
+        _, recording_ID, offset, checksum = CHUNK_HEADER.unpack_from(message)
+        if (recording_file := self.recording_files.get(recording_ID)) is None: return
+
+        # the following chunks are still on their way, request the file again from
+        # the corrupted chunk once they have all arrived
+        chunk = memoryview(message)[CHUNK_HEADER.size:]
+        if zlib.crc32(chunk) != checksum or offset != recording_file.received:
+            if offset + len(chunk) >= recording_file.size:
+                print(f"Resuming corrupted download of recording file {recording_file.filename}")
+                recording_file.close()
+                self.recording_files.pop(recording_ID)
+                await self.request_recording(recording_ID, recording_file.filename, recording_file.size)
+            return
+
+        recording_file.write(offset, chunk).add_done_callback(ChatroomClient.report_recording_file)
+
+        if recording_file.complete:
+            recording_file.close().add_done_callback(ChatroomClient.report_recording_file)
+            self.recording_files.pop(recording_ID)
+
+
+    @staticmethod
+    def report_recording_file(future: Future):
+        """Print the outcome of an operation on a recording file in the writer"""
+        if (e := future.exception()) is not None:
+            print("Failed to write recording file:", e)
+        elif (filename := future.result()) is not None:
+            print("Saved recording file", filename)
         
@@ -0,0 +1,394 @@
+import numpy as np
+
+
+class ImaAdpcm:
+    """
+    IMA ADPCM codec, compressing 16-bit samples to 4 bits. Blocks are independent
+    of one another, so that many blocks are encoded and decoded at once, one sample
+    position at a time.
+    """
+
+    STEP_TABLE = np.array([
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+        50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+        253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+        1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+        3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+        12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+    ], dtype=np.int32)
+    """Quantizer step size of each step index"""
+
+    INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int32)
+    """Change of the step index after each code"""
+
+
+    @staticmethod
+    def samples_per_block(block_align: int, channels: int) -> int:
+        """Number of frames in a block of the wave format"""
+        return (block_align - 4 * channels) * 2 // channels + 1
+
+
+    @staticmethod
+    def _step(code: np.ndarray, step: np.ndarray) -> np.ndarray:
+        """Difference to the predicted sample represented by a code"""
+        difference = step >> 3
+        difference += np.where(code & 4, step, 0)
+        difference += np.where(code & 2, step >> 1, 0)
+        difference += np.where(code & 1, step >> 2, 0)
+        return np.where(code & 8, -difference, difference)
+
+
+    @staticmethod
+    def encode_samples(samples: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Encode independent sequences of samples
+
+        Parameters
+        -----------
+        samples: np.ndarray
+            16-bit samples of shape (sequences, length)
+
+        Returns
+        ---------
+        predictor: np.ndarray
+            First sample of each sequence, of shape (sequences,)
+
+        index: np.ndarray
+            Initial step index of each sequence, of shape (sequences,)
+
+        codes: np.ndarray
+            4-bit codes of the following samples, of shape (sequences, length - 1)
+        """
+        samples = samples.astype(np.int32)
+        n, length = samples.shape
+
+        predictor = samples[:, 0].copy()
+
+        # start from the step size matching the first differences, instead of
+        # adapting from the smallest step
+        first_differences = np.abs(np.diff(samples[:, :9], axis=1)).mean(axis=1) if length > 1 else np.zeros(n)
+        index = np.searchsorted(ImaAdpcm.STEP_TABLE, first_differences).astype(np.int32)
+        index = np.clip(index, 0, len(ImaAdpcm.STEP_TABLE) - 1)
+        initial_index = index.copy()
+
+        codes = np.empty((n, length - 1), dtype=np.uint8)
+        value = predictor.copy()
+
+        for i in range(1, length):
+            step = ImaAdpcm.STEP_TABLE[index]
+            difference = samples[:, i] - value
+
+            code = np.where(difference < 0, 8, 0)
+            difference = np.abs(difference)
+
+            # quantize the difference in units of a quarter step
+            quantized = np.minimum((difference << 2) // step, 7)
+            code |= quantized
+
+            value = np.clip(value + ImaAdpcm._step(code, step), -32768, 32767)
+            index = np.clip(index + ImaAdpcm.INDEX_TABLE[code], 0, len(ImaAdpcm.STEP_TABLE) - 1)
+            codes[:, i - 1] = code
+
+        return predictor, initial_index, codes
+
+
+    @staticmethod
+    def decode_samples(predictor: np.ndarray, index: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        Decode independent sequences of samples, the inverse of `encode_samples`
+
+        Returns
+        ---------
+        16-bit samples of shape (sequences, length)
+        """
+        n, length = codes.shape
+        samples = np.empty((n, length + 1), dtype=np.int16)
+
+        value = predictor.astype(np.int32)
+        index = index.astype(np.int32)
+        samples[:, 0] = value
+
+        for i in range(length):
+            code = codes[:, i].astype(np.int32)
+            value = np.clip(value + ImaAdpcm._step(code, ImaAdpcm.STEP_TABLE[index]), -32768, 32767)
+            index = np.clip(index + ImaAdpcm.INDEX_TABLE[code], 0, len(ImaAdpcm.STEP_TABLE) - 1)
+            samples[:, i + 1] = value
+
+        return samples
+
+
+    @staticmethod
+    def encode_blocks(samples: np.ndarray, block_align: int) -> bytes:
+        """
+        Encode blocks of the IMA ADPCM wave format
+
+        Parameters
+        -----------
+        samples: np.ndarray
+            16-bit samples of shape (blocks, samples_per_block, channels)
+
+        block_align: int
+            Size of a block in bytes
+
+        Returns
+        ---------
+        Encoded blocks
+        """
+        n_blocks, length, channels = samples.shape
+        assert length == ImaAdpcm.samples_per_block(block_align, channels)
+
+        sequences = samples.transpose(0, 2, 1).reshape(n_blocks * channels, length)
+        predictor, index, codes = ImaAdpcm.encode_samples(sequences)
+
+        # header of each channel: first sample, step index and a reserved byte
+        header = np.zeros((n_blocks, channels, 4), dtype=np.uint8)
+        header[..., :2] = predictor.astype("<i2").view(np.uint8).reshape(n_blocks, channels, 2)
+        header[..., 2] = index.reshape(n_blocks, channels)
+
+        # codes are interleaved by channel in groups of 8, two per byte with the
+        # first in the low nibble
+        codes = codes.reshape(n_blocks, channels, -1, 8).transpose(0, 2, 1, 3)
+        data = codes[..., 0::2] | (codes[..., 1::2] << 4)
+
+        return np.concatenate(
+            (header.reshape(n_blocks, -1), data.reshape(n_blocks, -1)), axis=1
+        ).tobytes()
+
+
+    @staticmethod
+    def decode_blocks(data: bytes, block_align: int, channels: int) -> np.ndarray:
+        """
+        Decode blocks of the IMA ADPCM wave format, the inverse of `encode_blocks`
+
+        Returns
+        ---------
+        16-bit samples of shape (blocks, samples_per_block, channels)
+        """
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, block_align)
+        n_blocks = len(blocks)
+
+        header = blocks[:, : 4 * channels].reshape(n_blocks, channels, 4)
+        predictor = header[..., :2].copy().view("<i2").reshape(-1)
+        index = header[..., 2].reshape(-1)
+
+        data = blocks[:, 4 * channels :].reshape(n_blocks, -1, channels, 4)
+        codes = np.stack((data & 15, data >> 4), axis=-1).reshape(n_blocks, -1, channels, 8)
+        codes = codes.transpose(0, 2, 1, 3).reshape(n_blocks * channels, -1)
+
+        samples = ImaAdpcm.decode_samples(predictor, index, codes)
+        return samples.reshape(n_blocks, channels, -1).transpose(0, 2, 1)
+
+
+
+class AudioCodec:
+    """
+    Base class of the codecs of the chatroom audio, which encode blocks of float
+    samples in [-1, 1] of shape (frames, channels) as the payload of binary audio
+    frames
+    """
+
+    ID = None
+    """ID of the codec in the header of an audio frame"""
+    name = None
+    """Name the codec is chosen by"""
+
+
+    @staticmethod
+    def to_int16(data: np.ndarray) -> np.ndarray:
+        """Convert float samples in [-1, 1] to 16-bit"""
+        return np.int16(np.clip(data, -1, 1) * 32767)
+
+
+    def encode(self, data: np.ndarray) -> bytes:
+        """
+        Encode a block of audio
+
+        Parameters
+        -----------
+        data: np.ndarray
+            Float samples in [-1, 1] of shape (frames, channels)
+
+        Returns
+        ---------
+        Payload of the audio frame
+        """
+        raise NotImplementedError
+
+
+    def decode(self, payload: bytes, frames: int, channels: int) -> np.ndarray:
+        """
+        Decode a block of audio, the inverse of `encode`
+
+        Returns
+        ---------
+        Float samples in [-1, 1] of shape (frames, channels)
+        """
+        raise NotImplementedError
+
+
+    def level(self, payload: bytes, frames: int, channels: int) -> float:
+        """RMS level of a block of audio, measured from its payload"""
+        samples = self.decode(payload, frames, channels)
+        return float(np.sqrt(np.mean(np.square(samples)))) if samples.size > 0 else 0.
+
+
+
+class Float32Codec(AudioCodec):
+    """Sends the captured samples unchanged, 4 bytes per sample"""
+
+    ID = 0
+    name = "float32"
+
+    def encode(self, data: np.ndarray) -> bytes:
+        return np.ascontiguousarray(data, dtype="<f4").tobytes()
+
+    def decode(self, payload: bytes, frames: int, channels: int) -> np.ndarray:
+        return np.frombuffer(payload, dtype="<f4", count=frames * channels).reshape(frames, channels)
+
+
+
+class Pcm16Codec(AudioCodec):
+    """16-bit linear PCM, 2 bytes per sample"""
+
+    ID = 1
+    name = "pcm16"
+
+    def encode(self, data: np.ndarray) -> bytes:
+        return AudioCodec.to_int16(data).astype("<i2").tobytes()
+
+    def decode(self, payload: bytes, frames: int, channels: int) -> np.ndarray:
+        samples = np.frombuffer(payload, dtype="<i2", count=frames * channels)
+        return (samples / np.float32(32768)).reshape(frames, channels)
+
+
+
+class MuLawCodec(AudioCodec):
+    """G.711 μ-law, compressing 16-bit samples logarithmically to 1 byte per sample"""
+
+    ID = 2
+    name = "mulaw"
+
+    BIAS = 0x84
+    """Added to the magnitude of a sample, so that each segment starts at a power of 2"""
+    CLIP = 32635
+    """Largest magnitude of a sample before the bias"""
+
+
+    @staticmethod
+    def compress(samples: np.ndarray) -> np.ndarray:
+        """Compress 16-bit samples to μ-law codes"""
+        samples = samples.astype(np.int32)
+        sign = np.where(samples < 0, 0x80, 0)
+        magnitude = np.minimum(np.abs(samples), MuLawCodec.CLIP) + MuLawCodec.BIAS
+
+        # segment of the magnitude between 2^7 and 2^15, and 4 bits within it
+        exponent = np.frexp(magnitude)[1] - 8
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+
+        return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+
+    @staticmethod
+    def expand(codes: np.ndarray) -> np.ndarray:
+        """Expand μ-law codes to 16-bit samples, the inverse of `compress`"""
+        codes = ~codes.astype(np.int32) & 0xFF
+        exponent = (codes >> 4) & 0x07
+        mantissa = codes & 0x0F
+
+        magnitude = (((mantissa << 3) + MuLawCodec.BIAS) << exponent) - MuLawCodec.BIAS
+        return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+    def encode(self, data: np.ndarray) -> bytes:
+        return MuLawCodec.compress(AudioCodec.to_int16(data)).astype(np.uint8).tobytes()
+
+    def decode(self, payload: bytes, frames: int, channels: int) -> np.ndarray:
+        codes = np.frombuffer(payload, dtype=np.uint8, count=frames * channels)
+        return (MuLawCodec.expand(codes) / np.float32(32768)).reshape(frames, channels)
+
+
+
+class AdpcmCodec(AudioCodec):
+    """
+    IMA ADPCM in small independent blocks, about 4.75 bits per sample. The blocks
+    of an audio frame are encoded at once, so that the samples are looped over
+    only `BLOCK` times.
+    """
+
+    ID = 3
+    name = "adpcm"
+
+    BLOCK = 32
+    """Number of frames in a block"""
+
+
+    def encode(self, data: np.ndarray) -> bytes:
+        frames, channels = data.shape
+        n_blocks = -(-frames // AdpcmCodec.BLOCK)
+
+        samples = np.zeros((n_blocks * AdpcmCodec.BLOCK, channels), dtype=np.int16)
+        samples[:frames] = AudioCodec.to_int16(data)
+        sequences = samples.reshape(n_blocks, AdpcmCodec.BLOCK, channels).transpose(0, 2, 1)
+        predictor, index, codes = ImaAdpcm.encode_samples(sequences.reshape(-1, AdpcmCodec.BLOCK))
+
+        # the first sample is in the header, so the codes are padded to pairs
+        codes = np.pad(codes, ((0, 0), (0, 1)))
+        packed = codes[:, 0::2] | (codes[:, 1::2] << 4)
+
+        return predictor.astype("<i2").tobytes() + index.astype(np.uint8).tobytes() + packed.tobytes()
+
+
+    def decode(self, payload: bytes, frames: int, channels: int) -> np.ndarray:
+        n_blocks = -(-frames // AdpcmCodec.BLOCK)
+        n = n_blocks * channels
+
+        predictor = np.frombuffer(payload, dtype="<i2", count=n)
+        index = np.frombuffer(payload, dtype=np.uint8, count=n, offset=2 * n)
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=3 * n).reshape(n, AdpcmCodec.BLOCK // 2)
+
+        codes = np.stack((packed & 15, packed >> 4), axis=-1).reshape(n, AdpcmCodec.BLOCK)[:, :-1]
+        samples = ImaAdpcm.decode_samples(predictor, index, codes)
+
+        samples = samples.reshape(n_blocks, channels, AdpcmCodec.BLOCK).transpose(0, 2, 1).reshape(-1, channels)
+        return samples[:frames] / np.float32(32768)
+
+
+    def level(self, payload: bytes, frames: int, channels: int) -> float:
+        # decoding loops over the samples, estimate the level from the first sample
+        # of each block, stored unencoded, instead
+        predictor = np.frombuffer(payload, dtype="<i2", count=-(-frames // AdpcmCodec.BLOCK) * channels)
+        return float(np.sqrt(np.mean(np.square(predictor / 32768)))) if predictor.size > 0 else 0.
+
+
+
+AUDIO_CODECS = {codec.name: codec for codec in (Float32Codec(), Pcm16Codec(), MuLawCodec(), AdpcmCodec())}
+"""Codecs of the chatroom audio by name"""
+AUDIO_CODEC_IDS = {codec.ID: codec for codec in AUDIO_CODECS.values()}
+"""Codecs of the chatroom audio by ID"""
+
+
+
+if __name__ == "__main__":
+    # size, speed and quality of the codecs on blocks of captured audio
+    import timeit
+
+    rate, frames, channels, seconds = 44100, 1024, 1, 10
+    rng = np.random.default_rng(0)
+    t = np.arange(rate * seconds) / rate
+    voice = .3 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2 + rng.normal(0, .01, t.size)
+    blocks = [b.reshape(-1, channels).astype(np.float32) for b in np.array_split(voice, t.size // frames)]
+
+    print(f"{'codec':>8} {'ratio':>6} {'encode (ms)':>12} {'decode (ms)':>12} {'SNR (dB)':>9}")
+    for codec in AUDIO_CODECS.values():
+        payloads = [codec.encode(b) for b in blocks]
+        decoded = np.concatenate([codec.decode(p, len(b), channels) for p, b in zip(payloads, blocks)])
+        original = np.concatenate(blocks)
+
+        ratio = original.nbytes / sum(len(p) for p in payloads)
+        encode = timeit.timeit(lambda: [codec.encode(b) for b in blocks], number=1) / len(blocks) * 1000
+        decode = timeit.timeit(
+            lambda: [codec.decode(p, len(b), channels) for p, b in zip(payloads, blocks)], number=1
+        ) / len(blocks) * 1000
+        snr = 10 * np.log10(np.sum(original ** 2) / max(np.sum((original - decoded) ** 2), 1e-20))
+
+        print(f"{codec.name:>8} {ratio:>6.1f} {encode:>12.3f} {decode:>12.3f} {snr:>9.1f}")
@@ -1,2 +1,21 @@
+import os
+
 HOST = "10.13.95.11" # IP address of the server machine (connected to CUHK1X)
 ENHANCEMENT = False # whether enhancement features are enabled
+VIDEO_BITRATE = 1_000_000 # target webcam bandwidth of each sender (bit/s)
+VIDEO_DELTA = False # whether webcam images are sent as the tiles that changed only
+VIDEO_BACKGROUND = "blur" # how the webcam background is replaced when enabled, "blur" or "flat"
+VIDEO_LAST_N = 4 # number of the most recent speakers whose webcam is sent to each participant, None to send everyone's
+RECORDING_STEMS = False # whether the track of each participant is delivered with a recording
+RECORDING_DOWNLOAD_RATE = 4_000_000 # maximum rate of sending a recording file to a client (byte/s)
+RECORDING_DENOISE = False # whether the noise of each participant is reduced in a recording
+RECORDING_LOUDNESS = -20. # loudness (dBFS) each participant is normalized to in a recording, None to disable
+RECORDING_FORMAT = "pcm" # default encoding of the recordings of a chatroom, "pcm" or "adpcm"
+RECORDING_REPLAY = 0 # length (min) of the latest audio of a chatroom kept for instant replay, about 10 MB per minute, 0 to disable
+CHATROOM_WORKERS = os.cpu_count() or 1 # number of processes hosting the chatrooms, on the ports after the system server
+CHATROOM_WORKER_CAPACITY = 200 # number of participants a worker process is placed chatrooms up to
+CHATROOM_IDLE_TIMEOUT = 300. # time (s) a chatroom is kept without participants before it is closed, None to keep it
+AUDIO_CODEC = "mulaw" # default codec of the audio sent in a chatroom, "float32", "pcm16", "mulaw" or "adpcm"
+AUDIO_VAD = True # whether the microphone audio is withheld while the user is silent, noise is played in its place
+AUDIO_SPEAKERS = 3 # number of the loudest participants whose audio is forwarded in a chatroom, None to forward everyone's, 0 for nobody's
+REQUEST_TIMEOUT = 2. # time (s) a client waits for the reply of a server to a request
@@ -13,6 +13,8 @@ import math
 import asyncio
 import numpy as np
 
+from config import RECORDING_REPLAY
+
 
 class GUI(QMainWindow):
     """Handles the GUI of the voicechat system"""
@@ -81,6 +83,15 @@ class GUI(QMainWindow):
         create_chatroom_button.clicked.connect(self.create_chatroom)
         chatroom_layout.addWidget(create_chatroom_button)
 
+        # Recording file list, click to download
+        recording_list_label = QLabel()
+        recording_list_label.setText("Recordings")
+        chatroom_layout.addWidget(recording_list_label)
+
+        self.recording_list_widget = QListWidget()
+        self.recording_list_widget.itemClicked.connect(self.download_recording)
+        chatroom_layout.addWidget(self.recording_list_widget)
+
 
         # Chatroom interface
         chatroom_widget = QWidget()
@@ -110,6 +121,12 @@ class GUI(QMainWindow):
         self.recording_button.clicked.connect(self.toggle_recording)
         self.recording_button.setFixedSize(3 * GUI.BUTTON_SIZE, GUI.BUTTON_SIZE)
         recording_layout.addWidget(self.recording_button)
+
+        self.replay_button = QPushButton("Save replay")
+        self.replay_button.clicked.connect(self.save_replay)
+        self.replay_button.setFixedSize(3 * GUI.BUTTON_SIZE, GUI.BUTTON_SIZE)
+        self.replay_button.setVisible(RECORDING_REPLAY > 0)
+        recording_layout.addWidget(self.replay_button)
         
         self.update_recording_status(False)
 
@@ -124,6 +141,7 @@ class GUI(QMainWindow):
         self.chat_widget.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.chat_widget.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.chat_widget.setItemDelegate(self.participant_delegate)
+        self.chat_widget.itemDoubleClicked.connect(self.toggle_pin)
 
         voicechat_layout.addWidget(self.chat_widget)
 
@@ -144,6 +162,12 @@ class GUI(QMainWindow):
         self.update_filter_button(False)
         control_layout.addWidget(self.filter_button)
 
+        self.background_button = QPushButton("BG")
+        self.background_button.clicked.connect(self.toggle_background)
+        self.background_button.setFixedSize(GUI.BUTTON_SIZE, GUI.BUTTON_SIZE)
+        self.update_background_button(False)
+        control_layout.addWidget(self.background_button)
+
         self.microphone_button = QPushButton()
         self.microphone_button.clicked.connect(self.toggle_microphone)
         self.microphone_button.setFixedSize(GUI.BUTTON_SIZE, GUI.BUTTON_SIZE)
@@ -214,12 +238,15 @@ class GUI(QMainWindow):
         self.join_chatroom_message_box.setFixedSize(400, 200)
 
 
-    @pyqtSlot(list)
+    @pyqtSlot(dict)
     def update_chatroom_list(self, *args):
-        """Update chatroom list"""
+        """Update chatroom list, with the number of participants in each chatroom"""
         chatroom_list = args[0]
-        for cid in chatroom_list:
-            self.chatroom_list_widget.addItem(f"Chatroom {cid}")
+        self.chatroom_list_widget.clear()
+        for cid, participants in sorted(chatroom_list.items()):
+            item = QListWidgetItem(f"Chatroom {cid} ({participants} participants)")
+            item.setData(Qt.UserRole, cid)
+            self.chatroom_list_widget.addItem(item)
 
     
     @pyqtSlot(list)
@@ -254,10 +281,13 @@ class GUI(QMainWindow):
             c = i % grid_size
             
             item_widget = QTableWidgetItem()
+            item_widget.setData(Qt.UserRole + 1, participant.id)
 
-            # display a green border if microphone is unmuted
-            if participant.microphone:
+            # display a green border if the participant is speaking, a blue one if pinned
+            if participant.id in self.user.active_speakers:
                 item_widget.setData(Qt.UserRole, QPen(QColor("#32CD32"), 5))
+            elif participant.id in self.user.pinned:
+                item_widget.setData(Qt.UserRole, QPen(QColor("#1E90FF"), 3))
 
             # display the webcam image if webcam is on, otherwise, show the participant name
             if participant.webcam and participant.image is not None:
@@ -345,6 +375,28 @@ class GUI(QMainWindow):
             self.recording_button.setIcon(QIcon("util/play.svg"))         
 
 
+    @pyqtSlot(list)
+    def update_recording_list(self, *args):
+        """Update list of recording files available for download"""
+        recording_list = args[0]
+        self.recording_list_widget.clear()
+        for recording in recording_list:
+            filename = recording["filename"].replace("\\", "/").split("/")[-1]
+            item = QListWidgetItem(f"{filename} ({recording['size'] / (1 << 20):.1f} MB)")
+            item.setData(Qt.UserRole, recording["ID"])
+            self.recording_list_widget.addItem(item)
+
+
+    @pyqtSlot(object)
+    def update_recording_progress(self, *args):
+        """Update progress of finalizing a stopped recording"""
+        recording_progress = args[0]
+        if recording_progress is not None:
+            self.recording_label.setText(f"Finalizing recording ({recording_progress:.0%})")
+        elif not self.main.recording_status:
+            self.recording_label.setText("Recording stopped")
+
+
     def update_microphone_button(self, on: bool):
         if on:
             self.microphone_button.setIcon(QIcon("util/mic-mute.svg"))
@@ -381,6 +433,13 @@ class GUI(QMainWindow):
             self.filter_button.setToolTip("Turn on filter")  
 
 
+    def update_background_button(self, on: bool):
+        if on:
+            self.background_button.setToolTip("Turn off background filter")
+        else:
+            self.background_button.setToolTip("Turn on background filter")
+
+
     def create_chatroom(self, *args):
         """Create a chatroom"""
         if self.user.connected_chatroom:
@@ -399,8 +458,7 @@ class GUI(QMainWindow):
             self.join_chatroom_message_box.exec()
             return
         
-        chatroom_ID = args[0].text().split()[-1]
-        chatroom_ID = int(chatroom_ID)
+        chatroom_ID = args[0].data(Qt.UserRole)
         asyncio.run_coroutine_threadsafe(self.user.join_chatroom(chatroom_ID), self.sys_loop)
         
         self.update_microphone_button(True)
@@ -415,6 +473,7 @@ class GUI(QMainWindow):
         self.update_microphone_button(False)
         self.update_speaker_button(False)
         self.update_webcam_button(False)
+        self.update_background_button(False)
 
 
     def toggle_microphone(self, *args):
@@ -445,29 +504,60 @@ class GUI(QMainWindow):
         self.update_filter_button(result.result())
 
 
+    def toggle_background(self, *args):
+        """Toggle webcam background filter on and off"""
+        if not self.user.connected_chatroom or not self.user.webcam: return
+        result = asyncio.run_coroutine_threadsafe(self.user.toggle_background(), self.sys_loop)
+        self.update_background_button(result.result())
+
+
+    def toggle_pin(self, *args):
+        """Pin or unpin the participant double clicked, whose webcam is always shown while pinned"""
+        if not self.user.connected_chatroom: return
+        participant_ID = args[0].data(Qt.UserRole + 1)
+        asyncio.run_coroutine_threadsafe(self.user.toggle_pin(participant_ID), self.sys_loop)
+
+
     def toggle_recording(self, *args):
         """Toggle recording"""
         if not self.user.connected_chatroom: return
         asyncio.run_coroutine_threadsafe(self.user.toggle_recording(), self.sys_loop)
 
 
+    def save_replay(self, *args):
+        """Save the latest audio of the chatroom as a recording file"""
+        if not self.user.connected_chatroom: return
+        asyncio.run_coroutine_threadsafe(self.user.save_replay(), self.sys_loop)
+
+
+    def download_recording(self, *args):
+        """Download a recording file"""
+        if not self.user.connected_chatroom: return
+        recording_ID = args[0].data(Qt.UserRole)
+        asyncio.run_coroutine_threadsafe(self.user.download_recording(recording_ID), self.sys_loop)
+
+
 
 class Main(QObject):
     """Handles GUI main loop functions that retrieves data from server"""
 
-    UPDATE_CHATROOM = pyqtSignal(list)
+    UPDATE_CHATROOM = pyqtSignal(dict)
     UPDATE_PARTICIPANT_DATA = pyqtSignal(list)
     UPDATE_PARTICIPANT_LIST = pyqtSignal(list)
     UPDATE_RECORDING_STATUS = pyqtSignal(bool)
+    UPDATE_RECORDING_PROGRESS = pyqtSignal(object)
+    UPDATE_RECORDING_LIST = pyqtSignal(list)
 
     def __init__(self, gui: GUI):
         super().__init__()
         self.gui = gui
         self.set_signal()
         
-        self.chatroom_list = []
+        self.chatroom_list = {}
         self.participant_list = []
         self.recording_status = False
+        self.recording_progress = None
+        self.recording_list = []
 
 
     def set_signal(self):
@@ -475,24 +565,19 @@ class Main(QObject):
         self.UPDATE_PARTICIPANT_DATA.connect(self.gui.update_participant_data)
         self.UPDATE_PARTICIPANT_LIST.connect(self.gui.update_participant_list) ### withhold
         self.UPDATE_RECORDING_STATUS.connect(self.gui.update_recording_status)
+        self.UPDATE_RECORDING_PROGRESS.connect(self.gui.update_recording_progress)
+        self.UPDATE_RECORDING_LIST.connect(self.gui.update_recording_list)
 
 
     @pyqtSlot()
     def run(self):
         """Retrieve data from server, and update the GUI if changed"""
 
-        # get chatroom list from system server
-        result = asyncio.run_coroutine_threadsafe(
-            self.gui.user.request_chatroom_list(), self.gui.sys_loop
-        )
-        # only update if changed
-        chatroom_list = result.result()
-        if chatroom_list is not None and chatroom_list != self.chatroom_list:     
-            # only add newly-created chatrooms to list
-            new_list = list(set(chatroom_list) - set(self.chatroom_list))
-            if len(new_list) > 0:
-                self.UPDATE_CHATROOM.emit(new_list)
+        # chatroom list, kept up to date by the changes sent from the system server
+        chatroom_list = self.gui.user.chatroom_list
+        if chatroom_list != self.chatroom_list:
             self.chatroom_list = chatroom_list
+            self.UPDATE_CHATROOM.emit(chatroom_list)
 
 
         # get participant data from the chatroom server
@@ -520,10 +605,22 @@ class Main(QObject):
         )
         # only update if changed
         recording_status = result.result()
-        if recording_status != self.recording_status:
+        if recording_status is not None and recording_status != self.recording_status:
             self.recording_status = recording_status
             self.UPDATE_RECORDING_STATUS.emit(recording_status)
 
+        # progress of finalizing a stopped recording
+        recording_progress = self.gui.user.recording_progress
+        if recording_progress != self.recording_progress:
+            self.recording_progress = recording_progress
+            self.UPDATE_RECORDING_PROGRESS.emit(recording_progress)
+
+        # recording files available for download
+        recording_list = self.gui.user.recordings
+        if recording_list != self.recording_list:
+            self.recording_list = recording_list
+            self.UPDATE_RECORDING_LIST.emit(recording_list)
+
 
 
 class ParticipantDelegate(QStyledItemDelegate):
@@ -539,7 +636,7 @@ class ParticipantDelegate(QStyledItemDelegate):
     
         painter.save()
 
-        # draw a border if the participant is not muted
+        # draw a border if the participant is speaking or pinned
         if (data := index.data(Qt.UserRole)) is not None:
             painter.setPen(data)
             painter.drawRect(option.rect.adjusted(1, 1, -1, -1))
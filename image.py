@@ -3,8 +3,13 @@ from status_type import StatusType
 from filter import filtering
 
 import cv2
+import mediapipe as mp
 import numpy as np
 import threading
+import time
+from collections import deque
+
+from config import VIDEO_BITRATE, VIDEO_BACKGROUND
 
 
 class Image:
@@ -61,9 +66,18 @@ class Image:
 
 
     @staticmethod
-    def encode(frame: np.ndarray, *, ext: str = ".jpg") -> np.ndarray | StatusType:
-        """Encode a captured frame, default JPG"""
-        status, encoded_frame = cv2.imencode(ext, frame) # encode to JPG
+    def resize(frame: np.ndarray, scale: float) -> np.ndarray:
+        """Scale a captured frame by a factor"""
+        if scale == 1: return frame
+        h, w = frame.shape[:2]
+        return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+    @staticmethod
+    def encode(frame: np.ndarray, *, ext: str = ".jpg", quality: int = None) -> np.ndarray | StatusType:
+        """Encode a captured frame, default JPG at the default quality of OpenCV"""
+        params = [] if quality is None else [cv2.IMWRITE_JPEG_QUALITY, quality]
+        status, encoded_frame = cv2.imencode(ext, frame, params) # encode to JPG
         if not status:
             print("Cannot encode frame")
             return StatusType.ERROR
@@ -75,3 +89,393 @@ class Image:
         """Decode a frame to RGB image"""
         return cv2.imdecode(frame, flags)
 
+
+    @staticmethod
+    def split_tiles(size: tuple[int, int], grid: tuple[int, int]) -> list[tuple[slice, slice]]:
+        """
+        Split a frame into a grid of tiles
+
+        Parameters
+        -----------
+        size: tuple[int, int]
+            Height and width of the frame
+
+        grid: tuple[int, int]
+            Number of rows and columns of tiles
+
+        Returns
+        ---------
+        Row and column slices of each tile, in row-major order
+        """
+        (h, w), (rows, cols) = size, grid
+        ys = np.linspace(0, h, rows + 1, dtype=int)
+        xs = np.linspace(0, w, cols + 1, dtype=int)
+        return [
+            (slice(ys[r], ys[r+1]), slice(xs[c], xs[c+1]))
+            for r in range(rows) for c in range(cols)
+        ]
+
+
+
+
+class RateController:
+    """
+    Adapts the JPEG quality, resolution and frame rate of the webcam stream to a
+    target bandwidth, using the congestion feedback from the chatroom server
+    """
+
+    LEVELS = [
+        # (JPEG quality, scale, frame rate), from best to worst
+        (80, 1.0, 15),
+        (70, 1.0, 12),
+        (60, .75, 12),
+        (50, .75, 10),
+        (40, .5, 8),
+        (30, .5, 5),
+        (25, .25, 3),
+    ]
+    WINDOW = 2.0
+    """Period (s) over which the bitrate is measured"""
+    QUEUE_LIMIT = 1 << 16
+    """Bytes pending in a write buffer above which a link is considered congested"""
+
+
+    def __init__(self, bitrate: int = VIDEO_BITRATE):
+        self.bitrate = bitrate
+        """Target bandwidth (bit/s)"""
+        self.level = 0
+        """Index of the current setting in `LEVELS`"""
+
+        self._sent = deque()
+        """Timestamps and sizes of the frames sent within the window"""
+        self._next_frame = 0.
+        self._last_change = 0.
+
+
+    @property
+    def quality(self) -> int:
+        """JPEG quality of the current setting"""
+        return RateController.LEVELS[self.level][0]
+
+    @property
+    def scale(self) -> float:
+        """Resolution scale of the current setting"""
+        return RateController.LEVELS[self.level][1]
+
+    @property
+    def framerate(self) -> int:
+        """Frame rate of the current setting"""
+        return RateController.LEVELS[self.level][2]
+
+
+    @property
+    def measured_bitrate(self) -> float:
+        """Bandwidth (bit/s) used by the frames sent within the window"""
+        self._expire(time.monotonic())
+        return sum(size for _, size in self._sent) * 8 / RateController.WINDOW
+
+
+    def wait(self) -> float:
+        """Seconds until the next frame is due, 0 if it can be captured now"""
+        return max(0., self._next_frame - time.monotonic())
+
+
+    def sent(self, size: int):
+        """
+        Account for a frame that has been sent, and adapt the setting to the
+        measured bitrate
+
+        Parameters
+        -----------
+        size: int
+            Size of the encoded frame in bytes
+        """
+        now = time.monotonic()
+        self._next_frame = now + 1 / self.framerate
+        self._sent.append((now, size))
+
+        bitrate = self.measured_bitrate
+        if bitrate > self.bitrate:
+            self._change(+1)
+
+        # only step up if the better setting is expected to stay within the target
+        elif self.level > 0 and bitrate < .6 * self.bitrate:
+            self._change(-1, hold=2 * RateController.WINDOW)
+
+
+    def skip(self):
+        """Account for a frame that has been skipped without sending"""
+        self._next_frame = time.monotonic() + 1 / self.framerate
+
+
+    def congested(self):
+        """Degrade the setting when the local connection cannot keep up"""
+        self._change(+1)
+
+
+    def feedback(self, queue_depth: int, drops: int):
+        """
+        Handle the congestion feedback reported by the chatroom server
+
+        Parameters
+        -----------
+        queue_depth: int
+            Largest number of bytes pending to any of the receivers
+
+        drops: int
+            Number of frames the server did not deliver to the receivers
+        """
+        if drops > 0 or queue_depth > RateController.QUEUE_LIMIT:
+            self._change(+1)
+
+
+    def _expire(self, now: float):
+        """Forget the frames sent before the window"""
+        while self._sent and self._sent[0][0] < now - RateController.WINDOW:
+            self._sent.popleft()
+
+
+    def _change(self, step: int, *, hold: float = WINDOW):
+        """Move the setting by a step, at most once within a holding period"""
+        now = time.monotonic()
+        if now - self._last_change < hold: return
+
+        level = min(max(self.level + step, 0), len(RateController.LEVELS) - 1)
+        if level == self.level: return
+
+        self.level = level
+        self._last_change = now
+
+
+
+class ChangeDetector:
+    """
+    Detects webcam frames that barely differ from the last frame sent, by comparing
+    downscaled grayscale thumbnails
+    """
+
+    SIZE = (32, 24)
+    """Resolution of the thumbnails"""
+    THRESHOLD = 3.0
+    """Mean absolute difference of gray levels below which a frame is unchanged"""
+    KEYFRAME_INTERVAL = 5.0
+    """Period (s) after which a frame is sent even if unchanged"""
+
+
+    def __init__(self, *, threshold: float = THRESHOLD, keyframe_interval: float = KEYFRAME_INTERVAL):
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+
+        self.frames = 0
+        """Number of frames checked"""
+        self.skipped = 0
+        """Number of frames found unchanged"""
+
+        self._reference = None
+        """Thumbnail of the last frame sent"""
+        self._reference_time = 0.
+
+
+    @property
+    def skip_ratio(self) -> float:
+        """Fraction of the checked frames that were found unchanged"""
+        return self.skipped / self.frames if self.frames > 0 else 0.
+
+
+    def changed(self, frame: np.ndarray) -> bool:
+        """
+        Check whether a frame has to be sent. If so, it becomes the reference for
+        the following frames.
+
+        Parameters
+        -----------
+        frame: np.ndarray
+            RGB frame captured from the webcam
+        """
+        thumbnail = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        thumbnail = cv2.resize(thumbnail, ChangeDetector.SIZE, interpolation=cv2.INTER_AREA)
+        self.frames += 1
+
+        now = time.monotonic()
+        if self._reference is not None and now - self._reference_time < self.keyframe_interval:
+            difference = cv2.absdiff(thumbnail, self._reference).mean()
+            if difference < self.threshold:
+                self.skipped += 1
+                return False
+
+        self._reference = thumbnail
+        self._reference_time = now
+        return True
+
+
+    def reset(self):
+        """Forget the reference, so that the next frame is sent"""
+        self._reference = None
+
+
+
+class TileEncoder:
+    """
+    Splits webcam frames into a grid of tiles, and encodes only the tiles that
+    changed since they were last sent
+    """
+
+    GRID = (4, 4)
+    """Number of rows and columns of tiles"""
+    THRESHOLD = 4.0
+    """Mean absolute difference of gray levels below which a tile is unchanged"""
+    KEYFRAME_INTERVAL = 10.0
+    """Period (s) after which all tiles are sent"""
+
+
+    def __init__(self, *, grid: tuple[int, int] = GRID, threshold: float = THRESHOLD):
+        self.grid = grid
+        self.threshold = threshold
+
+        self._reference = None
+        """Grayscale frame holding the content of each tile last sent"""
+        self._keyframe_time = 0.
+
+
+    def encode(self, frame: np.ndarray, *, quality: int = None) -> tuple[bool, list[tuple[int, np.ndarray]]]:
+        """
+        Encode the tiles of a frame that have to be sent
+
+        Parameters
+        -----------
+        frame: np.ndarray
+            RGB frame captured from the webcam
+
+        quality: int, default = `None`
+            JPEG quality of the tiles
+
+        Returns
+        ---------
+        keyframe: bool
+            Whether all tiles are sent
+
+        tiles: list[tuple[int, np.ndarray]]
+            Index and JPG data of each tile to be sent
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        now = time.monotonic()
+
+        keyframe = self._reference is None or \
+                   self._reference.shape != gray.shape or \
+                   now - self._keyframe_time > TileEncoder.KEYFRAME_INTERVAL
+
+        if keyframe:
+            self._reference = np.zeros_like(gray)
+            self._keyframe_time = now
+        else:
+            # mean difference of each tile, by averaging the difference image down to the grid
+            rows, cols = self.grid
+            difference = cv2.resize(cv2.absdiff(gray, self._reference), (cols, rows), interpolation=cv2.INTER_AREA)
+            changed = difference.flatten() >= self.threshold
+
+        tiles = []
+        for i, (ys, xs) in enumerate(Image.split_tiles(gray.shape, self.grid)):
+            if not keyframe and not changed[i]: continue
+
+            if (tile := Image.encode(frame[ys, xs], quality=quality)) is StatusType.ERROR:
+                continue
+            tiles.append((i, tile))
+            self._reference[ys, xs] = gray[ys, xs]
+
+        return keyframe, tiles
+
+
+    def reset(self):
+        """Send all tiles with the next frame"""
+        self._reference = None
+
+
+
+class BackgroundFilter:
+    """
+    Blurs or flattens the background of webcam frames, so that they encode to
+    smaller JPG images
+    """
+
+    SIZE = (256, 144)
+    """Resolution at which the segmentation runs"""
+    BLUR_SIZE = (160, 120)
+    """Resolution at which the background is blurred"""
+    FLAT_COLOR = (128, 128, 128)
+    """Color of a flattened background"""
+    MEASURE_INTERVAL = 30
+    """Number of frames between measurements of the size saving"""
+
+    _segmentation = None
+    """Segmentation model, loaded once and shared"""
+
+
+    def __init__(self, mode: str = VIDEO_BACKGROUND):
+        assert mode in ("blur", "flat")
+        self.mode = mode
+        """How the background is replaced, `"blur"` or `"flat"`"""
+
+        self.frames = 0
+        """Number of frames filtered"""
+        self.original_size = 0
+        """Total JPG size of the measured frames before filtering"""
+        self.filtered_size = 0
+        """Total JPG size of the measured frames after filtering"""
+
+
+    @property
+    def saving(self) -> float:
+        """Measured fraction of the JPG size saved by filtering"""
+        if self.original_size == 0: return 0.
+        return 1 - self.filtered_size / self.original_size
+
+
+    @classmethod
+    def segmentation(cls):
+        """Load the segmentation model on first use"""
+        if cls._segmentation is None:
+            cls._segmentation = mp.solutions.selfie_segmentation.SelfieSegmentation(model_selection=1)
+        return cls._segmentation
+
+
+    def apply(self, frame: np.ndarray, *, quality: int = None) -> np.ndarray:
+        """
+        Replace the background of a frame
+
+        Parameters
+        -----------
+        frame: np.ndarray
+            RGB frame captured from the webcam
+
+        quality: int, default = `None`
+            JPEG quality the frame is going to be encoded at, for measuring the saving
+        """
+        h, w = frame.shape[:2]
+
+        # segment a downscaled frame, and scale the soft mask back up
+        small = cv2.resize(frame, BackgroundFilter.SIZE, interpolation=cv2.INTER_AREA)
+        results = BackgroundFilter.segmentation().process(small)
+        if results.segmentation_mask is None: return frame
+
+        mask = cv2.resize(results.segmentation_mask, (w, h), interpolation=cv2.INTER_LINEAR)
+        mask = cv2.GaussianBlur(mask, (0, 0), 3)[..., np.newaxis]
+
+        if self.mode == "blur":
+            background = cv2.resize(frame, BackgroundFilter.BLUR_SIZE, interpolation=cv2.INTER_AREA)
+            background = cv2.GaussianBlur(background, (0, 0), 5)
+            background = cv2.resize(background, (w, h), interpolation=cv2.INTER_LINEAR)
+        else:
+            background = np.empty_like(frame)
+            background[:] = BackgroundFilter.FLAT_COLOR
+
+        filtered = (frame * mask + background * (1 - mask)).astype(np.uint8)
+
+        # measure the saving on a sample of the frames
+        if self.frames % BackgroundFilter.MEASURE_INTERVAL == 0:
+            original, encoded = Image.encode(frame, quality=quality), Image.encode(filtered, quality=quality)
+            if original is not StatusType.ERROR and encoded is not StatusType.ERROR:
+                self.original_size += original.nbytes
+                self.filtered_size += encoded.nbytes
+        self.frames += 1
+
+        return filtered
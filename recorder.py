@@ -1,140 +1,1155 @@
+import os
 import tempfile
-import queue
 import datetime
+import struct
+import time
 import numpy as np
 
 import wave
-import noisereduce as nr
-import base64
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 
+from codec import ImaAdpcm
+from config import RECORDING_STEMS, RECORDING_DENOISE, RECORDING_LOUDNESS, RECORDING_FORMAT
 
-class Recorder:
 
-    def __init__(self, channels=2, rate=44100):
+class WavWriter:
+    """
+    Writes a 16-bit PCM wave file incrementally. The sizes in the header are
+    patched when the file is closed.
+    """
+
+    HEADER_SIZE = 44
+    """Size of the RIFF header in bytes"""
+
+    def __init__(self, filename: str, *, channels: int, rate: int):
+        self.filename = filename
         self.channels = channels
         self.rate = rate
 
-        self.buffer = queue.Queue()
+        self.frames = 0
+        """Number of frames written"""
+
+        self._file = open(filename, "wb")
+        self._file.write(self._header())
+
+
+    @property
+    def block_align(self) -> int:
+        """Size of a block in bytes"""
+        return 2 * self.channels
+
+    @property
+    def frames_per_block(self) -> int:
+        """Number of frames in a block"""
+        return 1
+
+
+    def _header(self) -> bytes:
+        """RIFF header of the wave file for the frames written so far"""
+        data_size = 2 * self.channels * self.frames
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + data_size, b"WAVE",
+            # format subchunk
+            b"fmt ", 16,
+            1, # AudioFormat
+            self.channels, self.rate,
+            2 * self.channels * self.rate, # ByteRate
+            2 * self.channels, # BlockAlign
+            16, # BitsPerSample
+            # data subchunk
+            b"data", data_size,
+        )
+
+
+    def write(self, data: np.ndarray):
+        """
+        Append audio data to the file
+
+        Parameters
+        -----------
+        data: np.ndarray
+            16-bit samples, interleaved by channel
+        """
+        assert data.dtype == np.int16
+
+        self._file.write(data.tobytes())
+        self.frames += data.size // self.channels
+
+
+    def write_blocks(self, data: bytes):
+        """
+        Append blocks already in the format of the file, e.g. from another file
+        written in the same format
+
+        Parameters
+        -----------
+        data: bytes
+            Whole blocks of `block_align` bytes
+        """
+        assert len(data) % self.block_align == 0
+
+        self._file.write(data)
+        self.frames += len(data) // self.block_align * self.frames_per_block
+
+
+    def close(self):
+        """Patch the header and close the file"""
+        if self._file.closed: return
+
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.close()
+
+
+
+
+class AdpcmWavWriter(WavWriter):
+    """
+    Writes an IMA ADPCM wave file incrementally, a quarter of the size of 16-bit
+    PCM. Samples are buffered and encoded a batch of blocks at a time.
+    """
+
+    HEADER_SIZE = 60
+    """Size of the RIFF header in bytes"""
+    BATCH = 256
+    """Number of blocks encoded at once"""
+
+    def __init__(self, filename: str, *, channels: int, rate: int):
+        self.blocks = 0
+        """Number of blocks written"""
+
+        super().__init__(filename, channels=channels, rate=rate)
+
+        self._buffered = 0
+        self._buffer = np.empty((self.BATCH * self.frames_per_block, channels), dtype=np.int16)
+
+
+    @property
+    def block_align(self) -> int:
+        return 256 * self.channels * max(1, self.rate // 11025)
+
+    @property
+    def frames_per_block(self) -> int:
+        return ImaAdpcm.samples_per_block(self.block_align, self.channels)
+
+
+    def _header(self) -> bytes:
+        data_size = self.block_align * self.blocks
+        return struct.pack(
+            "<4sI4s4sIHHIIHHHH4sII4sI",
+            b"RIFF", 52 + data_size, b"WAVE",
+            # format subchunk
+            b"fmt ", 20,
+            0x11, # AudioFormat
+            self.channels, self.rate,
+            self.block_align * self.rate // self.frames_per_block, # ByteRate
+            self.block_align, # BlockAlign
+            4, # BitsPerSample
+            2, self.frames_per_block, # extension
+            # fact subchunk, the number of frames without the padding of the last block
+            b"fact", 4, self.frames,
+            # data subchunk
+            b"data", data_size,
+        )
+
+
+    def write(self, data: np.ndarray):
+        assert data.dtype == np.int16
 
+        data = data.reshape(-1, self.channels)
+        self.frames += len(data)
 
-    def record(self, data: list):
-        """Put the audio into buffer"""
-        assert isinstance(data, list)
+        while len(data):
+            n = min(len(data), len(self._buffer) - self._buffered)
+            self._buffer[self._buffered : self._buffered + n] = data[:n]
+            self._buffered += n
+            data = data[n:]
 
+            if self._buffered == len(self._buffer):
+                self._flush()
+
+
+    def write_blocks(self, data: bytes):
+        assert self._buffered == 0
+
+        super().write_blocks(data)
+        self.blocks += len(data) // self.block_align
+
+
+    def _flush(self):
+        """Encode the buffered samples, padding the last block with silence"""
+        blocks = -(-self._buffered // self.frames_per_block)
+        if blocks == 0: return
+
+        samples = self._buffer[: blocks * self.frames_per_block]
+        samples[self._buffered :] = 0
+        self._file.write(ImaAdpcm.encode_blocks(
+            samples.reshape(blocks, self.frames_per_block, self.channels), self.block_align))
+
+        self.blocks += blocks
+        self._buffered = 0
+
+
+    def close(self):
+        if self._file.closed: return
+
+        self._flush()
+        super().close()
+
+
+
+class WavIndex:
+    """
+    Locates the time in a wave file written by `WavWriter` or `AdpcmWavWriter`
+    from its header. Their blocks have a fixed size, so that a segment of the
+    file is exported without reading the rest of it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+            assert riff == b"RIFF" and wave_id == b"WAVE"
+
+            # walk the subchunks to the data
+            while True:
+                chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+                if chunk_id == b"data": break
+
+                chunk = f.read(chunk_size + chunk_size % 2)
+                if chunk_id == b"fmt ":
+                    self.format, self.channels, self.rate, _, self.block_align = struct.unpack("<HHIIH", chunk[:14])
+
+            self.data_offset = f.tell()
+            """Byte offset of the first block"""
+            self.blocks = chunk_size // self.block_align
+            """Number of blocks"""
+
+        self.frames_per_block = 1 if self.format == 1 else ImaAdpcm.samples_per_block(self.block_align, self.channels)
+        """Number of frames in a block"""
+
+
+    @property
+    def duration(self) -> float:
+        """Length (s) of the audio, including the padding of the last block"""
+        return self.blocks * self.frames_per_block / self.rate
+
+
+    def block(self, time: float) -> int:
+        """Index of the block containing a time (s), within the file"""
+        return min(max(int(time * self.rate) // self.frames_per_block, 0), self.blocks)
+
+
+    def offset(self, time: float) -> int:
+        """Byte offset of the block containing a time (s)"""
+        return self.data_offset + self.block(time) * self.block_align
+
+
+    def export(self, path: str, start: float, end: float):
+        """
+        Copy the blocks of a time range to a new wave file, taking time linear in
+        the length of the range
+
+        Parameters
+        -----------
+        path: str
+            Path of the new wave file
+
+        start: float
+            Start time (s) of the range
+
+        end: float
+            End time (s) of the range, rounded up to a whole block
+        """
+        first = self.block(start)
+        last = self.block(end + (self.frames_per_block - 1) / self.rate)
+
+        writer = (AdpcmWavWriter if self.format == 0x11 else WavWriter)(path, channels=self.channels, rate=self.rate)
         try:
-            data = np.array(data).flatten()
-            self.buffer.put_nowait(data.copy())
+            with open(self.path, "rb") as f:
+                f.seek(self.data_offset + first * self.block_align)
+                blocks_per_read = max(1, (1 << 20) // self.block_align)
+                for i in range(first, last, blocks_per_read):
+                    writer.write_blocks(f.read(min(blocks_per_read, last - i) * self.block_align))
+        finally:
+            writer.close()
+
+
+
+
+class Loudness:
+    """
+    Running estimate of the loudness of audio, from a histogram of the levels of
+    short blocks. Blocks of silence and blocks much quieter than the rest are gated
+    out, so that neither pauses nor a single loud click skew the estimate.
+    """
+
+    BLOCK = .4
+    """Length (s) of the blocks the level is measured over"""
+    MIN_LEVEL = -70.
+    """Level (dBFS) below which a block is silence"""
+    RELATIVE_GATE = -10.
+    """Level (dB) relative to the loudness below which a block is gated out"""
+    BIN = .5
+    """Width (dB) of the histogram bins"""
+
+
+    def __init__(self, *, channels: int, rate: int):
+        self.block_size = int(Loudness.BLOCK * rate) * channels
+        """Number of samples in a block"""
+
+        n_bins = int(-Loudness.MIN_LEVEL / Loudness.BIN) + 1
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        """Number of blocks in each level bin"""
+        self.energies = np.zeros(n_bins)
+        """Total mean square of the blocks in each level bin"""
+
+        self._pending = np.zeros(self.block_size)
+        """Samples of the incomplete block"""
+        self._n_pending = 0
 
-        except self.buffer.Full:
-            return
+
+    def add(self, data: np.ndarray):
+        """
+        Account for audio data
+
+        Parameters
+        -----------
+        data: np.ndarray
+            Float samples in [-1, 1], interleaved by channel
+        """
+        data = data.flatten()
+        if data.size == 0: return
+
+        # complete the pending block first
+        n = min(self.block_size - self._n_pending, data.size)
+        self._pending[self._n_pending : self._n_pending + n] = data[:n]
+        self._n_pending += n
+        data = data[n:]
+        if self._n_pending < self.block_size: return
+
+        n_blocks = data.size // self.block_size
+        blocks = np.concatenate((self._pending, data[: n_blocks * self.block_size]))
+        energy = np.square(blocks).reshape(-1, self.block_size).mean(axis=1)
+
+        # keep the remaining samples for the next block
+        remaining = data[n_blocks * self.block_size :]
+        self._pending[: remaining.size] = remaining
+        self._n_pending = remaining.size
+
+        level = 10 * np.log10(energy + 1e-12)
+        energy, level = energy[level > Loudness.MIN_LEVEL], level[level > Loudness.MIN_LEVEL]
+        bins = np.minimum(((level - Loudness.MIN_LEVEL) / Loudness.BIN).astype(int), len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        self.energies += np.bincount(bins, weights=energy, minlength=len(self.counts))
+
+
+    @property
+    def loudness(self) -> float | None:
+        """Gated loudness (dBFS), or `None` if there is nothing but silence"""
+        if (count := self.counts.sum()) == 0: return None
+
+        ungated = 10 * np.log10(self.energies.sum() / count)
+        first_bin = int((ungated + Loudness.RELATIVE_GATE - Loudness.MIN_LEVEL) / Loudness.BIN)
+        first_bin = max(first_bin, 0)
+
+        return float(10 * np.log10(self.energies[first_bin:].sum() / self.counts[first_bin:].sum()))
+
+
+
+class CaptureClock:
+    """
+    Places the audio of a participant by the time it was captured at, on the server
+    clock, using the smallest observed difference between the two clocks
+    """
+
+    def __init__(self):
+        self.offset = None
+        """Smallest observed difference between the server clock and the participant clock"""
+
+
+    def position(self, timestamp: float, arrival: float, *, start: float, rate: int) -> int:
+        """
+        Convert the capture time of audio data to a frame position
+
+        Parameters
+        -----------
+        timestamp: float
+            Time the audio was captured at, on the participant clock
+
+        arrival: float
+            Time the audio was received at, on the server clock
+
+        start: float
+            Time of frame position 0, on the server clock
+
+        rate: int
+            Sample rate of the frame positions
+        """
+        # the smallest difference corresponds to the audio delivered with the least delay
+        if self.offset is None or arrival - timestamp < self.offset:
+            self.offset = arrival - timestamp
+
+        return round((timestamp + self.offset - start) * rate)
+
+
+
+class Track:
+    """
+    Recording of a single participant, with the audio placed by the time it was
+    captured at
+    """
+
+    TOLERANCE = .05
+    """Gap (s) between consecutive audio data below which it is not filled with silence"""
+    MAX_GAIN = 20.
+    """Largest amplification or attenuation (dB) applied when normalizing"""
+
+
+    def __init__(self, filename: str, *, channels: int, rate: int, start: float):
+        self.writer = WavWriter(filename, channels=channels, rate=rate)
+        """Writes the track to a wave file"""
+        self.start = start
+        """Time the recording started at, on the server clock"""
+
+        self.clock = CaptureClock()
+        """Places the audio of the participant by its capture time"""
+        self.loudness = Loudness(channels=channels, rate=rate)
+        """Running loudness estimate of the track"""
+
+
+    @property
+    def filename(self) -> str:
+        return self.writer.filename
+
+    @property
+    def frames(self) -> int:
+        return self.writer.frames
+
+
+    def position(self, timestamp: float, arrival: float) -> int:
+        """
+        Convert the capture time of audio data to a frame position in the track
+
+        Parameters
+        -----------
+        timestamp: float
+            Time the audio was captured at, on the participant clock
+
+        arrival: float
+            Time the audio was received at, on the server clock
+        """
+        return self.clock.position(timestamp, arrival, start=self.start, rate=self.writer.rate)
 
 
-    def convert_recording(self):
+    def write(self, data: np.ndarray, position: int):
         """
-        Convert the recorded audio data to wave file encoded in base64
+        Write audio data at a frame position, filling any gap before it with silence
+
+        Parameters
+        -----------
+        data: np.ndarray
+            16-bit samples of shape (frames, channels)
+
+        position: int
+            Frame position of the audio data
+        """
+        gap = position - self.writer.frames
+        if gap > Track.TOLERANCE * self.writer.rate:
+            for i in range(0, gap, Recorder.BLOCK):
+                self.writer.write(np.zeros(min(Recorder.BLOCK, gap - i) * self.writer.channels, dtype=np.int16))
+
+        self.writer.write(data.flatten())
+        self.loudness.add(data / 32768)
+
+
+    def gain(self, target: float) -> float:
+        """
+        Linear gain bringing the track to a target loudness, within `MAX_GAIN`
+
+        Parameters
+        -----------
+        target: float
+            Target loudness (dBFS)
+        """
+        if (loudness := self.loudness.loudness) is None: return 1.
+        gain = np.clip(target - loudness, -Track.MAX_GAIN, Track.MAX_GAIN)
+        return float(10 ** (gain / 20))
+
+
+    def close(self):
+        self.writer.close()
+
+
+
+class Recording:
+    """A stopped recording, whose tracks are mixed into the output files"""
+
+    LIMIT = .9
+    """Level above which the peaks of the mixed recording are softly limited"""
+
+    def __init__(self, filename: str, tracks: dict, *, channels: int, rate: int):
+        self.filename = filename
+        """Filename of the mixed recording delivered to the clients"""
+        self.tracks = tracks
+        """Dict `{participant ID: Track}` of the recorded tracks"""
+        self.channels = channels
+        self.rate = rate
+
+
+    def finalize(self, *, stems: bool = RECORDING_STEMS, denoise: bool = RECORDING_DENOISE,
+                 loudness: float = RECORDING_LOUDNESS, format: str = RECORDING_FORMAT,
+                 progress = None) -> list[tuple[str, str]]:
+        """
+        Mix the tracks into a single wave file, block by block. It takes time
+        linear in the recording length, and is to be run in a worker thread.
+
+        Parameters
+        -----------
+        stems: bool, default = `RECORDING_STEMS`
+            If true, the track of each participant is also kept as a separate file
+
+        denoise: bool, default = `RECORDING_DENOISE`
+            If true, the noise of each track is reduced before mixing
+
+        loudness: float, default = `RECORDING_LOUDNESS`
+            Loudness (dBFS) each track is normalized to from its running loudness
+            estimate, no normalization if `None`
+
+        format: str, default = `RECORDING_FORMAT`
+            Encoding of the mixed recording, "pcm" or "adpcm"
+
+        progress: Callable[[float], None], default = `None`
+            Called with the fraction of the recording finalized, at most once per percent
 
         Returns
         ---------
-        filename: str
-            Filename of the wave file
+        Filename delivered to the clients and path on the server of each output
+        file, starting with the mixed recording
+        """
+        # denoising takes the first half of the progress if enabled
+        mix_progress = progress
+        if denoise:
+            self.denoise(progress=None if progress is None else lambda p: progress(p / 2))
+            if progress is not None:
+                mix_progress = lambda p: progress(.5 + p / 2)
+
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        mix = (AdpcmWavWriter if format == "adpcm" else WavWriter)(path, channels=self.channels, rate=self.rate)
+
+        files = [open(track.filename, "rb") for track in self.tracks.values()]
+        length = max(track.frames for track in self.tracks.values())
+        gains = [
+            1. if loudness is None else track.gain(loudness)
+            for track in self.tracks.values()
+        ]
+
+        try:
+            for f in files: f.seek(WavWriter.HEADER_SIZE)
+
+            # sum the same block of every track with its gain, then limit the peaks
+            percent = 0
+            for i in range(0, length, Recorder.BLOCK):
+                block = np.zeros(min(Recorder.BLOCK, length - i) * self.channels, dtype=np.float32)
+                for f, gain in zip(files, gains):
+                    data = np.frombuffer(f.read(2 * block.size), dtype=np.int16)
+                    block[:data.size] += data * np.float32(gain / 32768)
+                mix.write(np.int16(Recording.limit(block) * 32767))
+
+                if mix_progress is not None and (done := 100 * mix.frames // length) > percent:
+                    percent = done
+                    mix_progress(percent / 100)
+
+        finally:
+            for f in files: f.close()
+            mix.close()
+
+        outputs = [(self.filename, path)]
+        for participant_ID, track in self.tracks.items():
+            if stems:
+                stem_filename = self.filename.replace('.wav', f'_participant{participant_ID}.wav')
+                outputs.append((stem_filename, track.filename))
+            else:
+                os.remove(track.filename)
+
+        return outputs
+
+
+    @staticmethod
+    def limit(data: np.ndarray) -> np.ndarray:
+        """Softly limit float samples to [-1, 1], leaving those below `LIMIT` unchanged"""
+        magnitude = np.abs(data)
+        over = magnitude > Recording.LIMIT
+
+        headroom = 1 - Recording.LIMIT
+        magnitude[over] = Recording.LIMIT + headroom * np.tanh((magnitude[over] - Recording.LIMIT) / headroom)
+        return np.copysign(magnitude, data)
 
-        filedata: str
-            Binary wave file encoded in base64
+
+    def denoise(self, *, progress = None):
+        """
+        Reduce the noise of every track, in parallel in a process pool
+
+        Parameters
+        -----------
+        progress: Callable[[float], None], default = `None`
+            Called with the fraction of the tracks denoised, whenever one is done
+        """
+        sources = [track.filename for track in self.tracks.values()]
+        targets = [source.replace('.wav', '_denoised.wav') for source in sources]
+
+        with ProcessPoolExecutor() as pool:
+            for i, _ in enumerate(pool.map(Recorder.denoise_audio, sources, targets)):
+                if progress is not None: progress((i + 1) / len(sources))
+
+        for source, target in zip(sources, targets):
+            os.replace(target, source)
+
+
+    def discard(self):
+        """Delete the recorded tracks"""
+        for track in self.tracks.values():
+            os.remove(track.filename)
+
+
+
+class RecordingFile:
+    """
+    A recording file downloaded in chunks, written to disk as they arrive. The
+    data is kept in a `.part` file until complete, so that an interrupted download
+    can be resumed from where it stopped.
+
+    Given a writer, the chunks are written and the file is closed in it, and the
+    file is to be opened in it too, so that a thread receiving the chunks never
+    waits for the disk. A writer with a single thread keeps the operations on the
+    files in order.
+    """
+
+    def __init__(self, filename: str, size: int, *, writer: Executor = None):
+        self.filename = filename
+        self.size = size
+        """Size of the file in bytes"""
+        self.partname = filename + ".part"
+        """Filename of the incomplete file"""
+        self.writer = writer
+        """Executor the chunks are written in, `None` to write them at once"""
+
+        if (directory := os.path.dirname(filename)) != "":
+            os.makedirs(directory, exist_ok=True)
+
+        # resume from the end of any incomplete file
+        self._file = open(self.partname, "r+b" if os.path.exists(self.partname) else "wb")
+        self.received = min(self._file.seek(0, os.SEEK_END), size)
+        """Number of bytes received, from the start of the file"""
+
+
+    @property
+    def complete(self) -> bool:
+        """Whether the whole file has been received"""
+        return self.received >= self.size
+
+
+    def _submit(self, function, *args) -> Future:
+        """Run a file operation in the writer, or at once without one"""
+        if self.writer is not None:
+            return self.writer.submit(function, *args)
+
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+    def write(self, offset: int, chunk: bytes) -> Future:
+        """Write a chunk at its offset in the file"""
+        self.received = max(self.received, offset + len(chunk))
+        return self._submit(self._write, offset, chunk)
+
+
+    def _write(self, offset: int, chunk: bytes):
+        self._file.seek(offset)
+        self._file.write(chunk)
+
+
+    def close(self) -> Future:
+        """Close the file, and move it to its filename if complete, resulting in the filename then"""
+        return self._submit(self._close, self.received, self.complete)
+
+
+    def _close(self, received: int, complete: bool):
+        self._file.truncate(received)
+        self._file.close()
+        if complete:
+            # replaced at once, so that the file is either absent or complete
+            os.replace(self.partname, self.filename)
+            return self.filename
+
+
+
+class ReplayBuffer:
+    """
+    The last minutes of the mixed audio of a chatroom, kept in a ring buffer of
+    a fixed size allocated once. Audio of the participants is summed in by the
+    time it was captured at.
+    """
+
+    def __init__(self, length: float, *, channels: int, rate: int):
+        """
+        Parameters
+        -----------
+        length: float
+            Length (s) of the audio kept
         """
+        self.channels = channels
+        self.rate = rate
+
+        self.buffer = np.zeros((int(length * rate), channels), dtype=np.int16)
+        """Ring buffer of 16-bit samples, frame position `i` is at index `i % len(buffer)`"""
+        self.start = time.monotonic()
+        """Time of frame position 0, on the server clock"""
+        self.end = 0
+        """Frame position after the latest audio"""
+
+        self.clocks = {}
+        """Dict `{participant ID: CaptureClock}` placing the audio of each participant by its capture time"""
+
+        self._sum = np.zeros((Recorder.BLOCK, channels), dtype=np.int32)
+        """Buffer the audio is summed in before saturating to 16-bit"""
+
+
+    def _slices(self, start: int, stop: int) -> tuple[slice, slice]:
+        """Slices of the ring buffer holding frame positions `[start, stop)`, at most a buffer long"""
+        i = start % len(self.buffer)
+        first = min(stop - start, len(self.buffer) - i)
+        return slice(i, i + first), slice(0, stop - start - first)
+
 
-        filename = tempfile.mktemp(
+    def add(self, participant_ID: int, data: list | np.ndarray, *,
+            timestamp: float = None, rate: int = None, channels: int = None):
+        """
+        Mix the audio data of a participant into the buffer, see `Recorder.record`
+        for the parameters
+        """
+        arrival = time.monotonic()
+        if timestamp is None: timestamp = arrival
+
+        clock = self.clocks.setdefault(participant_ID, CaptureClock())
+        position = clock.position(timestamp, arrival, start=self.start, rate=self.rate)
+
+        data = np.asarray(data, dtype=np.float32).reshape(-1, channels or self.channels)
+        data = Recorder.convert(data, rate=rate or self.rate, to_rate=self.rate, to_channels=self.channels)
+        data = np.int16(np.clip(data, -1, 1) * 32767)
+
+        # drop the audio older than the buffer
+        if (late := self.end - len(self.buffer) - position) > 0:
+            data = data[late:]
+            position += late
+        if (excess := len(data) - len(self.buffer)) > 0:
+            data = data[excess:]
+            position += excess
+        if len(data) == 0: return
+
+        end = position + len(data)
+        self.advance(end)
+
+        if len(self._sum) < len(data):
+            self._sum = np.zeros((len(data), self.channels), dtype=np.int32)
+
+        i = 0
+        for s in self._slices(position, end):
+            n = s.stop - s.start
+            total = self._sum[:n]
+            np.add(self.buffer[s], data[i : i + n], out=total, dtype=np.int32)
+            np.clip(total, -32768, 32767, out=total)
+            self.buffer[s] = total
+            i += n
+
+
+    def advance(self, end: int):
+        """
+        Move the end of the buffer forward to a frame position, clearing the frames
+        left from a buffer earlier before audio is summed into them
+        """
+        if end <= self.end: return
+
+        for s in self._slices(max(self.end, end - len(self.buffer)), end):
+            self.buffer[s] = 0
+        self.end = end
+
+
+    def clip(self, length: float = None) -> np.ndarray:
+        """
+        Copy of the latest audio, up to now on the server clock, so that the
+        silence not sent by the participants is included
+
+        Parameters
+        -----------
+        length: float, default = `None`
+            Length (s) of the audio, the whole buffer if not given
+
+        Returns
+        ---------
+        16-bit samples of shape (frames, channels)
+        """
+        self.advance(round((time.monotonic() - self.start) * self.rate))
+
+        frames = min(self.end, len(self.buffer))
+        if length is not None:
+            frames = min(frames, int(length * self.rate))
+
+        return np.concatenate([self.buffer[s] for s in self._slices(self.end - frames, self.end)])
+
+
+    def export(self, path: str, data: np.ndarray, *, format: str = RECORDING_FORMAT):
+        """
+        Write a clip to a wave file, to be run in a worker thread
+
+        Parameters
+        -----------
+        path: str
+            Path of the wave file
+
+        data: np.ndarray
+            16-bit samples of shape (frames, channels) from `clip`
+
+        format: str, default = `RECORDING_FORMAT`
+            Encoding of the file, "pcm" or "adpcm"
+        """
+        writer = (AdpcmWavWriter if format == "adpcm" else WavWriter)(path, channels=self.channels, rate=self.rate)
+        try:
+            for i in range(0, len(data), Recorder.BLOCK):
+                writer.write(data[i : i + Recorder.BLOCK].reshape(-1))
+        finally:
+            writer.close()
+
+
+
+
+class Recorder:
+
+    BLOCK = 1 << 16
+    """Number of frames processed at once when writing silence or mixing"""
+
+
+    def __init__(self, channels=2, rate=44100):
+        self.channels = channels
+        """Number of channels of the recording, audio of participants is converted to it"""
+        self.rate = rate
+        """Sample rate of the recording, audio of participants is resampled to it"""
+
+        self.filename = None
+        """Filename of the recording delivered to the clients"""
+        self.tracks = None
+        """Dict `{participant ID: Track}` of the ongoing recording"""
+        self.start_time = None
+        """Time the ongoing recording started at"""
+
+
+    @property
+    def recording(self) -> bool:
+        """Whether a recording is ongoing"""
+        return self.tracks is not None
+
+
+    def start(self):
+        """Start a new recording"""
+        if self.recording and (recording := self.stop()) is not None:
+            recording.discard()
+
+        self.filename = tempfile.mktemp(
             prefix=datetime.datetime.now().strftime('%Y%m%d%H%M%S'), # Ensure the filename is unique
             suffix='.wav',
             dir='recording',
-        ) 
+        )
+        self.tracks = {}
+        self.start_time = time.monotonic()
 
-        filedata = bytes()
-        recording_data = np.empty((0))
 
-        while not self.buffer.empty():
-            data = self.buffer.get_nowait()
-            recording_data = np.concatenate((recording_data, data))
+    def record(self, participant_ID: int, data: list | np.ndarray, *,
+               timestamp: float = None, rate: int = None, channels: int = None):
+        """
+        Write the audio data of a participant to its track
 
-        if (size := recording_data.shape[0]) == 0:
-            return None
+        Parameters
+        -----------
+        participant_ID: int
+            ID of the participant who sent the audio
 
-        # Normalize the audio data
-        recording_data = np.int16(
-            recording_data / np.max(np.abs(recording_data)) * 32767
-        )
+        data: list | np.ndarray
+            Float samples in [-1, 1] of shape (frames, channels)
+
+        timestamp: float, default = `None`
+            Time the audio was captured at on the participant clock, the time it is
+            received at if not given
+
+        rate: int, default = `None`
+            Sample rate of the audio, the recording sample rate if not given
+
+        channels: int, default = `None`
+            Number of channels of the audio, the recording channels if not given
+        """
+        assert isinstance(data, (list, np.ndarray))
+
+        if not self.recording: return
 
-        # Write the RIFF header
-        filedata += (b'RIFF')
-        filedata += ((36 + 2 * size).to_bytes(4, 'little'))  # ChunkSize
-        filedata += (b'WAVE')
+        arrival = time.monotonic()
+        if timestamp is None: timestamp = arrival
 
-        # Write the format subchunk (fmt chunk)
-        filedata += (b'fmt ')
-        filedata += ((16).to_bytes(4, 'little'))  # Subchunk1Size
-        filedata += ((1).to_bytes(2, 'little'))  # AudioFormat
-        filedata += ((self.channels).to_bytes(2, 'little'))  # NumChannels
-        filedata += ((self.rate).to_bytes(4, 'little'))  # SampleRate
-        filedata += ((self.rate * 2).to_bytes(4, 'little'))  # ByteRate
-        filedata += ((2).to_bytes(2, 'little'))  # BlockAlign
-        filedata += ((16).to_bytes(2, 'little'))  # BitsPerSample
+        if (track := self.tracks.get(participant_ID)) is None:
+            fd, path = tempfile.mkstemp(suffix='.wav')
+            os.close(fd)
+            track = Track(path, channels=self.channels, rate=self.rate, start=self.start_time)
+            self.tracks[participant_ID] = track
 
-        # Write the data subchunk header
-        filedata += (b'data')
-        filedata += ((2 * size).to_bytes(4, 'little'))  # Subchunk2Size
+        data = np.asarray(data, dtype=np.float32).reshape(-1, channels or self.channels)
+        data = Recorder.convert(data, rate=rate or self.rate, to_rate=self.rate, to_channels=self.channels)
 
-        # Write the audio data
-        filedata += recording_data.tobytes()
+        # convert the float samples in [-1, 1] to 16-bit
+        data = np.int16(np.clip(data, -1, 1) * 32767)
+        track.write(data, track.position(timestamp, arrival))
 
-        filedata_str = base64.b64encode(filedata).decode("utf-8")
 
-        return filename, filedata_str
+    def stop(self) -> Recording | None:
+        """
+        Stop the recording, only the headers of the track files are patched
+
+        Returns
+        ---------
+        The stopped recording, or `None` if nothing was recorded
+        """
+        if not self.recording: return None
+
+        tracks, self.tracks = self.tracks, None
+        for track in tracks.values():
+            track.close()
+
+        if len(tracks) == 0:
+            return None
+
+        return Recording(self.filename, tracks, channels=self.channels, rate=self.rate)
 
 
     @staticmethod
-    def save_recording(filename: str, filedata_str: str):
+    def convert(data: np.ndarray, *, rate: int, to_rate: int, to_channels: int) -> np.ndarray:
         """
-        Save a wave file locally
+        Convert audio data to another sample rate and number of channels
 
         Parameters
-        -------------
-        filename: str
-            Filename of the wave file
+        -----------
+        data: np.ndarray
+            Float samples of shape (frames, channels)
 
-        filedata: str
-            Binary data of the wave file encoded in base64 
-        """
+        rate: int
+            Sample rate of the audio data
 
-        filedata = base64.b64decode(filedata_str)
+        to_rate: int
+            Sample rate to convert to, by linear interpolation
 
-        with open(filename, "wb") as f:
-            f.write(filedata)
+        to_channels: int
+            Number of channels to convert to, by averaging the channels
+        """
+        if data.shape[1] != to_channels:
+            data = np.repeat(data.mean(axis=1, keepdims=True), to_channels, axis=1)
 
-        print("Saved recording file", filename)
+        if rate != to_rate and len(data) > 0:
+            n_frames = round(len(data) * to_rate / rate)
+            x = np.arange(n_frames) * (rate / to_rate)
+            xp = np.arange(len(data))
+            data = np.stack([np.interp(x, xp, data[:, c]) for c in range(to_channels)], axis=1)
 
-        # denoise the audio
-        # Recorder.denoise_audio(filename, filename + "_denoised")
+        return data
 
 
-    ### under progress
     @staticmethod
-    def denoise_audio(source_file, target_file):
+    def denoise_audio(source_file: str, target_file: str):
+        """
+        Reduce the noise of a wave file block by block, so that memory use does not
+        depend on the length of the file
+
+        Parameters
+        -------------
+        source_file: str
+            16-bit PCM wave file to be denoised
+
+        target_file: str
+            Wave file to write the denoised audio to
+        """
         with wave.open(source_file, 'rb') as audio_file:
-            sample_w = audio_file.getsampwidth()
-            sample_r = audio_file.getframerate()
             num_ch = audio_file.getnchannels()
             num_fr = audio_file.getnframes()
 
-            audio_d = np.frombuffer(audio_file.readframes(num_fr), dtype=np.int16)
+            def read(start: int, end: int) -> np.ndarray:
+                audio_file.setpos(start)
+                data = np.frombuffer(audio_file.readframes(end - start), dtype=np.int16)
+                return data.reshape(-1, num_ch) / 32768
+
+            # estimate the noise profile once, from the quietest part of the file
+            denoiser = Denoiser(Denoiser.find_noise(read, num_fr, audio_file.getframerate()))
+
+            writer = WavWriter(target_file, channels=num_ch, rate=audio_file.getframerate())
+            try:
+                for start in range(0, num_fr, Denoiser.BLOCK):
+                    end = min(start + Denoiser.BLOCK, num_fr)
+
+                    # process the block with enough audio around it to be seamless
+                    context_start = max(start - Denoiser.CONTEXT, 0)
+                    context_end = min(end + Denoiser.CONTEXT, num_fr)
+                    data = read(context_start, context_end)
+
+                    denoised = np.stack([denoiser.process(data[:, c]) for c in range(num_ch)], axis=1)
+                    denoised = denoised[start - context_start : end - context_start]
+                    writer.write(np.int16(np.clip(denoised, -1, 1) * 32767).flatten())
+            finally:
+                writer.close()
+
+
+
+class Denoiser:
+    """
+    Reduces stationary noise by spectral gating, like `noisereduce`, but applied to
+    blocks of a recording with a noise profile estimated only once
+    """
+
+    N_FFT = 2048
+    """Window size of the short-time Fourier transform"""
+    HOP = 512
+    """Hop size of the short-time Fourier transform"""
+    N_STD = 1.5
+    """Number of standard deviations above the mean noise level a signal has to be"""
+    DECREASE = 1.0
+    """Proportion by which the noise is reduced"""
+    SMOOTHING = (2, 4)
+    """Number of frequency bins and time frames on each side the mask is smoothed over"""
 
-        if num_ch > 1:
-            audio_d = np.reshape(audio_d, (num_fr, num_ch))
+    BLOCK = 1 << 16
+    """Number of frames denoised at once"""
+    CONTEXT = 2 * N_FFT
+    """Number of frames around a block processed with it"""
+    NOISE_LENGTH = .5
+    """Length (s) of the audio the noise profile is estimated from"""
 
-        denoised_audio = nr.reduce_noise(audio_d)
 
-        with wave.open(target_file, 'wb') as processed_audio_file:
-            processed_audio_file.setsampwidth(sample_w)
-            processed_audio_file.setframerate(sample_r)
-            processed_audio_file.setnchannels(num_ch)
+    def __init__(self, noise: np.ndarray):
+        """
+        Parameters
+        -----------
+        noise: np.ndarray
+            Float samples of a part of the recording with noise only
+        """
+        self.window = np.hanning(Denoiser.N_FFT + 1)[:-1]
+
+        noise_db = Denoiser.decibel(self.stft(noise))
+        self.threshold = noise_db.mean(axis=0) + Denoiser.N_STD * noise_db.std(axis=0)
+        """Level (dB) of each frequency below which the signal is considered noise"""
+
+
+    @staticmethod
+    def find_noise(read, n_frames: int, rate: int) -> np.ndarray:
+        """
+        Find the quietest part of a recording, reading it block by block
+
+        Parameters
+        -----------
+        read: Callable[[int, int], np.ndarray]
+            Reads the float samples between two frame positions
+
+        n_frames: int
+            Number of frames of the recording
+
+        rate: int
+            Sample rate of the recording
+
+        Returns
+        ---------
+        Mono float samples of the quietest part
+        """
+        length = max(int(Denoiser.NOISE_LENGTH * rate), Denoiser.N_FFT)
+        block = Denoiser.BLOCK // length * length
+
+        quietest, quietest_energy = 0, np.inf
+        for start in range(0, max(n_frames - length + 1, 1), block):
+            # energy of each complete part within the block
+            data = read(start, min(start + block, n_frames)).mean(axis=1)
+            if (n_parts := len(data) // length) == 0: break
+
+            energy = np.square(data[: n_parts * length]).reshape(n_parts, length).mean(axis=1)
+            i = int(np.argmin(energy))
+            if energy[i] < quietest_energy:
+                quietest, quietest_energy = start + i * length, energy[i]
+
+        return read(quietest, min(quietest + length, n_frames)).mean(axis=1)
+
+
+    @staticmethod
+    def decibel(spectrum: np.ndarray) -> np.ndarray:
+        return 20 * np.log10(np.abs(spectrum) + 1e-10)
+
+
+    def stft(self, data: np.ndarray) -> np.ndarray:
+        """
+        Short-time Fourier transform, of shape (time frames, frequencies), with the
+        first samples centred in as many frames as the rest
+        """
+        data = np.pad(data, (Denoiser.N_FFT - Denoiser.HOP, 0), mode="reflect" if len(data) else "constant")
+        data = np.pad(data, (0, Denoiser.N_FFT - len(data) % Denoiser.HOP))
+
+        frames = np.lib.stride_tricks.sliding_window_view(data, Denoiser.N_FFT)[::Denoiser.HOP]
+        return np.fft.rfft(frames * self.window, axis=1)
+
+
+    def istft(self, spectrum: np.ndarray, length: int) -> np.ndarray:
+        """Inverse short-time Fourier transform by overlap-add"""
+        frames = np.fft.irfft(spectrum, n=Denoiser.N_FFT, axis=1) * self.window
+        overlap = Denoiser.N_FFT // Denoiser.HOP
+
+        size = (len(frames) - 1) * Denoiser.HOP + Denoiser.N_FFT
+        data, weight = np.zeros(size), np.zeros(size)
+
+        # frames that are `overlap` apart do not overlap, add each such set at once
+        for k in range(overlap):
+            n = len(frames[k::overlap])
+            offset = k * Denoiser.HOP
+            data[offset : offset + n * Denoiser.N_FFT] += frames[k::overlap].flatten()
+            weight[offset : offset + n * Denoiser.N_FFT] += np.tile(np.square(self.window), n)
+
+        # drop the padding `stft` added before the first samples
+        start = Denoiser.N_FFT - Denoiser.HOP
+        return (data / np.maximum(weight, 1e-10))[start : start + length]
+
+
+    @staticmethod
+    def smooth(mask: np.ndarray, size: int, axis: int) -> np.ndarray:
+        """Moving average of a mask along an axis"""
+        if size == 0: return mask
+
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (size + 1, size)
+        total = np.cumsum(np.pad(mask, padding, mode="edge"), axis=axis)
+
+        upper = np.take(total, np.arange(2 * size + 1, total.shape[axis]), axis=axis)
+        lower = np.take(total, np.arange(0, total.shape[axis] - 2 * size - 1), axis=axis)
+        return (upper - lower) / (2 * size + 1)
+
+
+    def process(self, data: np.ndarray) -> np.ndarray:
+        """
+        Reduce the noise of a single channel
+
+        Parameters
+        -----------
+        data: np.ndarray
+            Float samples of a channel
+        """
+        spectrum = self.stft(data)
 
-            processed_audio_file.writeframes(denoised_audio.tobytes())
+        # gate the time-frequency bins below the noise threshold, with a smoothed mask
+        mask = (Denoiser.decibel(spectrum) < self.threshold).astype(np.float64)
+        mask = Denoiser.smooth(mask, Denoiser.SMOOTHING[0], axis=1)
+        mask = Denoiser.smooth(mask, Denoiser.SMOOTHING[1], axis=0)
 
+        return self.istft(spectrum * (1 - Denoiser.DECREASE * mask), len(data))
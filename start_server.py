@@ -9,7 +9,11 @@ from system import SystemServer
 async def main():
     system = SystemServer()
     await system.start()
-    await asyncio.Future()
+    try:
+        await asyncio.Future()
+    finally:
+        # stop the chatroom workers, which are not daemonic
+        await system.close()
 
 
 if __name__ == "__main__":
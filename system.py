@@ -1,12 +1,15 @@
 from status_type import StatusType
-from chatroom import ChatroomServer
+from worker import ChatroomWorker
 
 import asyncio
 import websockets
 import json
+import heapq
+from abc import ABC, abstractmethod
 from enum import Enum
+from functools import partial
 
-from config import HOST
+from config import HOST, RECORDING_FORMAT, AUDIO_CODEC, CHATROOM_WORKERS, CHATROOM_WORKER_CAPACITY, REQUEST_TIMEOUT
 
 
 class EventType(Enum):
@@ -16,18 +19,212 @@ class EventType(Enum):
     JOIN_CHATROOM,
     CHATROOM_PORT,
     GET_CHATROOM_LIST, CHATROOM_LIST,
-    ) = list(range(5))
+    SUBSCRIBE_CHATROOM_LIST,
+    CHATROOM_CREATED, CHATROOM_CLOSED, CHATROOM_UPDATED,
+    ) = list(range(9))
+
+
+class RoomRegistry(ABC):
+    """
+    Keeps track of the nodes hosting chatrooms, with their capacity and load, and
+    of the chatroom placed on each node, and creates the chatrooms on the nodes.
+    Subclasses keep this state, in memory or in a service shared by the machines
+    hosting chatrooms.
+    """
+
+    @abstractmethod
+    def register(self, node_ID: str, *, host: str, port: int, capacity: int, node = None):
+        """
+        Add a node that chatrooms can be placed on
+
+        Parameters
+        -----------
+        node_ID: str
+            Unique ID of the node
+
+        host: str
+            IP address clients connect to the node at
+
+        port: int
+            Port clients connect to the node at
+
+        capacity: int
+            Number of participants the node is placed chatrooms up to
+
+        node: default = `None`
+            Handle creating chatrooms on the node, e.g. a `ChatroomWorker` of the
+            system server, if the registry does not reach the node by itself
+        """
+
+
+    @abstractmethod
+    def unregister(self, node_ID: str) -> list[int]:
+        """Remove a node, returning the IDs of the chatrooms that were on it"""
+
+
+    @abstractmethod
+    def report(self, node_ID: str, load: int):
+        """Update the number of participants on a node"""
+
+
+    @abstractmethod
+    def place(self, chatroom_ID: int) -> str | None:
+        """
+        Place a new chatroom on the node with the lowest load relative to its
+        capacity, returning the node ID, or `None` if every node is full
+        """
+
+
+    @abstractmethod
+    async def create_chatroom(self, node_ID: str, chatroom_ID: int, **options):
+        """
+        Create a placed chatroom on its node, and wait until it accepts clients
+
+        Parameters
+        -----------
+        node_ID: str
+            ID of the node the chatroom is placed on
+
+        chatroom_ID: int
+            ID of the chatroom
+
+        options:
+            Keyword arguments of `ChatroomServer`
+
+        Returns
+        -----------
+        `StatusType.ERROR` if the chatroom cannot be created
+        """
+
+
+    @abstractmethod
+    def locate(self, chatroom_ID: int) -> tuple[str, int] | None:
+        """IP address and port of the node hosting a chatroom, `None` if it does not exist"""
+
+
+    @abstractmethod
+    def remove(self, chatroom_ID: int):
+        """Remove a chatroom from its node"""
+
+
+    @abstractmethod
+    def chatroom_IDs(self) -> list[int]:
+        """IDs of all chatrooms"""
+
+
+
+class LocalRegistry(RoomRegistry):
+    """
+    Room registry kept in the memory of the system server, for the nodes on the
+    same machine, e.g. several worker processes listening on different loopback
+    addresses
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        """Dict `{node ID: dict}` of the address, capacity, load and number of chatrooms of each node"""
+        self.chatrooms = {}
+        """Dict `{chatroom ID: node ID}` of the node hosting each chatroom"""
+        self.handles = {}
+        """Dict `{node ID: handle}` creating the chatrooms on each node"""
+
+
+    def register(self, node_ID: str, *, host: str, port: int, capacity: int, node = None):
+        self.nodes[node_ID] = {"host": host, "port": port, "capacity": capacity, "load": 0, "chatrooms": 0}
+        self.handles[node_ID] = node
+
+
+    def unregister(self, node_ID: str) -> list[int]:
+        self.nodes.pop(node_ID, None)
+        self.handles.pop(node_ID, None)
+        chatroom_IDs = [ID for ID, node in self.chatrooms.items() if node == node_ID]
+        for chatroom_ID in chatroom_IDs:
+            del self.chatrooms[chatroom_ID]
+        return chatroom_IDs
+
+
+    def report(self, node_ID: str, load: int):
+        if (node := self.nodes.get(node_ID)) is not None:
+            node["load"] = load
+
+
+    def place(self, chatroom_ID: int) -> str | None:
+        available = [
+            (node["load"] / node["capacity"], node["chatrooms"], node_ID)
+            for node_ID, node in self.nodes.items() if node["load"] < node["capacity"]
+        ]
+        if len(available) == 0: return None
+
+        *_, node_ID = min(available)
+        self.chatrooms[chatroom_ID] = node_ID
+        self.nodes[node_ID]["chatrooms"] += 1
+        return node_ID
+
+
+    async def create_chatroom(self, node_ID: str, chatroom_ID: int, **options):
+        if (node := self.handles.get(node_ID)) is None:
+            print(f"Cannot create chatroom {chatroom_ID} on node {node_ID}, which has no handle")
+            return StatusType.ERROR
+
+        return await node.create_chatroom(chatroom_ID, **options)
+
+
+    def locate(self, chatroom_ID: int) -> tuple[str, int] | None:
+        if (node := self.nodes.get(self.chatrooms.get(chatroom_ID))) is None: return None
+        return node["host"], node["port"]
+
+
+    def remove(self, chatroom_ID: int):
+        if (node := self.nodes.get(self.chatrooms.pop(chatroom_ID, None))) is not None:
+            node["chatrooms"] -= 1
+
+
+    def chatroom_IDs(self) -> list[int]:
+        return list(self.chatrooms)
+
 
 
 class SystemServer:
-    """Handles the server side of the voicechat system"""
+    """
+    Handles the server side of the voicechat system, and places the chatrooms on
+    the nodes of a room registry, its own pool of worker processes by default
+    """
 
     port = 8000
+
+    PAGE_SIZE = 100
+    """Default number of chatrooms in a page of the chatroom list"""
        
 
-    def __init__(self):
+    def __init__(self, *, registry: RoomRegistry = None, workers: list[ChatroomWorker] = None):
+        """
+        Parameters
+        -----------
+        registry: RoomRegistry, default = `None`
+            Registry the chatrooms are placed with, a `LocalRegistry` if not given
+
+        workers: list[ChatroomWorker], default = `None`
+            Worker processes hosting the chatrooms, `CHATROOM_WORKERS` workers on
+            the ports after the system server if not given
+        """
         self.server = None
-        self.chatroom_list = {}
+        self.registry = LocalRegistry() if registry is None else registry
+        """Registry of the nodes hosting the chatrooms"""
+        self.chatroom_ID = 1
+        """ID of the next chatroom, if no ID is free"""
+        self.free_chatroom_IDs = []
+        """Heap of the IDs of the closed chatrooms, reused smallest first"""
+        self.participant_counts = {}
+        """Dict `{chatroom ID: int}` of the number of participants in each chatroom, as last reported"""
+        self.subscribers = set()
+        """Clients sent the changes of the chatroom list"""
+
+        if workers is None:
+            workers = [ChatroomWorker(SystemServer.port + 1 + i) for i in range(CHATROOM_WORKERS)]
+        self.workers = {worker.node_ID: worker for worker in workers}
+        """Dict `{node ID: ChatroomWorker}` of the worker processes hosting the chatrooms"""
+        self.worker_tasks = set()
+        """Tasks receiving the reports of the workers"""
 
 
     @property
@@ -38,11 +235,23 @@ class SystemServer:
 
     async def start(self):
         """Start the server"""
+        for worker in self.workers.values():
+            if (await worker.start()) == StatusType.ERROR:
+                await self.close_workers()
+                return StatusType.ERROR
+
+            self.registry.register(
+                worker.node_ID, host=worker.host, port=worker.port, capacity=CHATROOM_WORKER_CAPACITY, node=worker)
+            task = asyncio.create_task(self.listen_worker(worker))
+            self.worker_tasks.add(task)
+            task.add_done_callback(self.worker_tasks.discard)
+
         try:
             self.server = await websockets.serve(self.handler, host=HOST, port=SystemServer.port)
         
         except ConnectionRefusedError:
             print(f"Cannot start system server at port {HOST}:{SystemServer.port}")
+            await self.close_workers()
             return StatusType.ERROR
 
         else:
@@ -56,6 +265,8 @@ class SystemServer:
         """
         if not self.started: return StatusType.OK
 
+        await self.close_workers()
+
         self.server.close()
         await self.server.wait_closed()
 
@@ -64,6 +275,71 @@ class SystemServer:
         return StatusType.OK
 
 
+    async def close_workers(self):
+        """Close the chatrooms and stop the worker processes"""
+        await asyncio.gather(*(worker.close() for worker in self.workers.values()))
+
+
+    async def listen_worker(self, worker: ChatroomWorker):
+        """Report the load of a worker to the registry, and drop its chatrooms once it stops"""
+        await worker.listen(on_load=partial(self.update_load, worker), on_closed=self.remove_chatroom)
+        for chatroom_ID in self.registry.unregister(worker.node_ID):
+            self.free_chatroom(chatroom_ID)
+
+
+    def update_load(self, worker: ChatroomWorker, load: dict):
+        """
+        Report the load of a worker to the registry, and the number of participants
+        in each of its chatrooms to the subscribers if changed
+
+        Parameters
+        -----------
+        worker: ChatroomWorker
+
+        load: dict
+            Dict `{chatroom ID: int}` of the number of participants in each chatroom of the worker
+        """
+        self.registry.report(worker.node_ID, sum(load.values()))
+
+        for chatroom_ID, participants in load.items():
+            if chatroom_ID in self.participant_counts and self.participant_counts[chatroom_ID] != participants:
+                self.participant_counts[chatroom_ID] = participants
+                self.broadcast_chatroom_change(EventType.CHATROOM_UPDATED, chatroom_ID)
+
+
+    def remove_chatroom(self, chatroom_ID: int):
+        """Remove a closed chatroom from the registry, and free its ID"""
+        self.registry.remove(chatroom_ID)
+        self.free_chatroom(chatroom_ID)
+
+
+    def free_chatroom(self, chatroom_ID: int):
+        """Free the ID of a chatroom no longer in the registry, and report it closed to the subscribers"""
+        heapq.heappush(self.free_chatroom_IDs, chatroom_ID)
+        self.participant_counts.pop(chatroom_ID, None)
+        self.broadcast_chatroom_change(EventType.CHATROOM_CLOSED, chatroom_ID)
+
+
+    def broadcast_chatroom_change(self, event_type: EventType, chatroom_ID: int):
+        """
+        Send a change of a chatroom to the subscribers of the chatroom list
+
+        Parameters
+        -----------
+        event_type: EventType
+            `CHATROOM_CREATED`, `CHATROOM_CLOSED` or `CHATROOM_UPDATED`
+
+        chatroom_ID: int
+            ID of the chatroom
+        """
+        event = {
+            "type": event_type.value,
+            "ID": chatroom_ID,
+            "participants": self.participant_counts.get(chatroom_ID, 0),
+        }
+        websockets.broadcast(self.subscribers, json.dumps(event))
+
+
     async def handler(self, websocket: websockets.WebSocketClientProtocol):
         """
         Handles events sent from clients
@@ -75,45 +351,79 @@ class SystemServer:
                 match event_type:
                     # create a chatroom, then join the client
                     case EventType.CREATE_CHATROOM:
-                        if (chatroom_ID := await self.create_chatroom()) == StatusType.ERROR:
+                        recording_format = event.get("recording_format", RECORDING_FORMAT)
+                        audio_codec = event.get("audio_codec", AUDIO_CODEC)
+                        if (chatroom_ID := await self.create_chatroom(
+                                recording_format=recording_format, audio_codec=audio_codec)) == StatusType.ERROR:
+                            await self.send_chatroom_error(websocket, None, "Cannot create chatroom", event.get("request"))
                             continue
-                        await self.join_chatroom(websocket, chatroom_ID)
+                        await self.join_chatroom(websocket, chatroom_ID, event.get("request"))
                 
                     # join the client to an existing chatroom by ID
                     case EventType.JOIN_CHATROOM:
-                        await self.join_chatroom(websocket, event["chatroom_ID"])
+                        await self.join_chatroom(websocket, event["chatroom_ID"], event.get("request"))
 
-                    # send the chatroom list to a client
+                    # send a page of the chatroom list to a client
                     case EventType.GET_CHATROOM_LIST:
-                        await self.send_chatroom_list(websocket)
+                        await self.send_chatroom_list(
+                            websocket, event.get("offset", 0), event.get("limit", SystemServer.PAGE_SIZE),
+                            event.get("request"))
+
+                    # send a page of the chatroom list, then its changes, to a client
+                    case EventType.SUBSCRIBE_CHATROOM_LIST:
+                        self.subscribers.add(websocket)
+                        await self.send_chatroom_list(
+                            websocket, event.get("offset", 0), event.get("limit", SystemServer.PAGE_SIZE))
 
                 await asyncio.sleep(0)
 
         except websockets.exceptions.ConnectionClosed:
             return
 
+        finally:
+            self.subscribers.discard(websocket)
 
-    async def create_chatroom(self) -> int:
+
+    async def create_chatroom(self, *, recording_format: str = RECORDING_FORMAT, audio_codec: str = AUDIO_CODEC) -> int:
         """
-        Create a new chatroom server
+        Create a new chatroom server, on the node placed by the registry
+
+        Parameters
+        ---------------
+        recording_format: str, default = `RECORDING_FORMAT`
+            Encoding of the recordings of the chatroom, "pcm" or "adpcm"
+
+        audio_codec: str, default = `AUDIO_CODEC`
+            Codec of the audio sent in the chatroom, "float32", "pcm16", "mulaw" or "adpcm"
         
         Returns
         -----------
         ID of the created chatroom
         """
-        # create new chatroom server
-        chatroom_server = ChatroomServer()
-        
-        # start the chatroom server
-        if (await chatroom_server.start()) == StatusType.ERROR:
+        if len(self.free_chatroom_IDs) > 0:
+            chatroom_ID = heapq.heappop(self.free_chatroom_IDs)
+        else:
+            chatroom_ID = self.chatroom_ID
+            self.chatroom_ID += 1
+
+        # create new chatroom server on the least loaded node
+        if (node_ID := self.registry.place(chatroom_ID)) is None:
+            print("No chatroom node has capacity left")
+            heapq.heappush(self.free_chatroom_IDs, chatroom_ID)
             return StatusType.ERROR
 
-        # add chatroom to list
-        self.chatroom_list[chatroom_server.ID] = chatroom_server  
-        return chatroom_server.ID
+        if (await self.registry.create_chatroom(
+                node_ID, chatroom_ID, recording_format=recording_format, audio_codec=audio_codec)) == StatusType.ERROR:
+            self.registry.remove(chatroom_ID)
+            heapq.heappush(self.free_chatroom_IDs, chatroom_ID)
+            return StatusType.ERROR
 
+        self.participant_counts[chatroom_ID] = 0
+        self.broadcast_chatroom_change(EventType.CHATROOM_CREATED, chatroom_ID)
+        return chatroom_ID
 
-    async def join_chatroom(self, client: websockets.WebSocketClientProtocol, chatroom_ID: int):
+
+    async def join_chatroom(self, client: websockets.WebSocketClientProtocol, chatroom_ID: int, request: int = None):
         """
         Connect a client to a chatroom server by chatroom ID
         
@@ -123,27 +433,85 @@ class SystemServer:
 
         chatroom_ID: int
             ID of the chatroom to be connected to
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
         """
 
-        # retrieve port of chatroom server from ID
-        chatroom_server = self.chatroom_list[chatroom_ID]
-        port = chatroom_server.port
+        if (address := self.registry.locate(chatroom_ID)) is None:
+            return await self.send_chatroom_error(client, chatroom_ID, "Chatroom not found", request)
 
-        # send the port to the client
+        # send the address of the node hosting the chatroom to the client
+        host, port = address
         event = {
             "type": EventType.CHATROOM_PORT.value,
+            "host": host,
             "port": port,
             "ID": chatroom_ID,
+            "request": request,
+        }
+
+        await client.send(json.dumps(event))
+
+
+    async def send_chatroom_error(self, client: websockets.WebSocketClientProtocol,
+                                  chatroom_ID: int | None, error: str, request: int = None):
+        """
+        Reply to a request of creating or joining a chatroom that failed, with no
+        address of a chatroom server
+
+        Parameters
+        ---------------
+        client: WebSocketClientProtocol
+
+        chatroom_ID: int | None
+            ID of the chatroom requested, `None` if it was not created
+
+        error: str
+            Reason of the failure
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
+        """
+        event = {
+            "type": EventType.CHATROOM_PORT.value,
+            "host": None,
+            "port": None,
+            "ID": chatroom_ID,
+            "error": error,
+            "request": request,
         }
 
         await client.send(json.dumps(event))
 
 
-    async def send_chatroom_list(self, client):
-        """Send the chatroom list to a client"""
+    async def send_chatroom_list(self, client, offset: int = 0, limit: int = PAGE_SIZE, request: int = None):
+        """
+        Send a page of the chatroom list to a client, ordered by chatroom ID
+
+        Parameters
+        -----------
+        client: WebSocketClientProtocol
+
+        offset: int, default = 0
+            Number of chatrooms before the page
+
+        limit: int, default = `PAGE_SIZE`
+            Largest number of chatrooms in the page
+
+        request: int, default = `None`
+            ID of the request replied to, sent back to the client
+        """
+        chatroom_IDs = sorted(self.registry.chatroom_IDs())
         event = {
             "type": EventType.CHATROOM_LIST.value,
-            "list": list(self.chatroom_list.keys()),
+            "list": [
+                {"ID": chatroom_ID, "participants": self.participant_counts.get(chatroom_ID, 0)}
+                for chatroom_ID in chatroom_IDs[offset : offset + limit]
+            ],
+            "offset": offset,
+            "total": len(chatroom_IDs),
+            "request": request,
         }
         await client.send(json.dumps(event))
 
@@ -158,6 +526,11 @@ class SystemClient():
         self.user = user
         """The end user who this client belong to"""
 
+        self.requests = {}
+        """Dict `{request ID: Future}` of the requests waiting for the reply of the server"""
+        self.next_request = 0
+        """ID of the next request"""
+
 
     @property
     def connected(self) -> bool:
@@ -185,6 +558,11 @@ class SystemClient():
 
         await self.connection.close()
 
+        # no reply will come for the pending requests
+        for future in self.requests.values():
+            if not future.done(): future.set_result(None)
+        self.requests = {}
+
         print(f"Connection to system server at port {HOST}:{SystemServer.port} is closed")
         self.connection = None
         return StatusType.OK
@@ -200,15 +578,32 @@ class SystemClient():
                     event_type = EventType(event["type"])
 
                     match event_type:
-                        # connect the client to a chatroom server after receiving its
-                        # port from the system server
-                        case EventType.CHATROOM_PORT:
-                            await self.user.chatroom_client.connect(event["port"], event["ID"]) 
-                        
-                        # retrieve the chatroom list from the server
+                        # retrieve a page of the chatroom list from the server, the
+                        # list is replaced rather than modified as it is read by the GUI
                         case EventType.CHATROOM_LIST:
-                            self.user.chatroom_list = event["list"]
-                            
+                            chatroom_list = {} if event["offset"] == 0 else self.user.chatroom_list
+                            self.user.chatroom_list = {
+                                **chatroom_list,
+                                **{chatroom["ID"]: chatroom["participants"] for chatroom in event["list"]},
+                            }
+
+                            # fetch the rest of the list page by page, the changes of
+                            # all chatrooms are received already
+                            if event["list"] and (offset := event["offset"] + len(event["list"])) < event["total"]:
+                                await self.request_chatroom_list(offset)
+
+                        # apply a change of the chatroom list
+                        case EventType.CHATROOM_CREATED | EventType.CHATROOM_UPDATED:
+                            self.user.chatroom_list = {**self.user.chatroom_list, event["ID"]: event["participants"]}
+
+                        case EventType.CHATROOM_CLOSED:
+                            self.user.chatroom_list = {
+                                ID: participants for ID, participants in self.user.chatroom_list.items()
+                                if ID != event["ID"]
+                            }
+
+                    # wake the request replied to, after the reply is applied
+                    self.resolve(event)
                     await asyncio.sleep(0)
 
             except websockets.exceptions.ConnectionClosed:
@@ -242,56 +637,143 @@ class SystemClient():
             return StatusType.OK
 
 
-    async def request_chatroom_list(self) -> list[int]:
+    async def request(self, event: dict) -> dict | None:
         """
-        Send a request of getting the list of existing chatrooms to the system server
+        Send a request to the system server, and wait for its reply
+
+        Parameters
+        -----------
+        event: dict
+            Request to be sent, tagged with an ID the server sends back in its reply
 
         Returns
-        ----------
-        List of chatroom IDs
+        ---------
+        Reply of the server, `None` if no reply comes within `REQUEST_TIMEOUT`
         """
-        if not self.connected: return None
+        request_ID = self.next_request
+        self.next_request += 1
+        future = self.requests[request_ID] = asyncio.get_running_loop().create_future()
+
+        try:
+            if (await self.send({**event, "request": request_ID})) == StatusType.ERROR:
+                return None
+
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
 
+        except asyncio.TimeoutError:
+            print(f"No reply to {EventType(event['type']).name} from system server at port {HOST}:{SystemServer.port}")
+            return None
+
+        finally:
+            self.requests.pop(request_ID, None)
+
+
+    def resolve(self, event: dict):
+        """Pass an event received to the request it replies to, if any"""
+        if (future := self.requests.get(event.get("request"))) is not None and not future.done():
+            future.set_result(event)
+
+
+    async def request_chatroom_list(self, offset: int = 0, limit: int = SystemServer.PAGE_SIZE):
+        """
+        Send a request of getting a page of the list of existing chatrooms to the
+        system server
+
+        Parameters
+        ------------
+        offset: int, default = 0
+            Number of chatrooms before the page
+
+        limit: int, default = `SystemServer.PAGE_SIZE`
+            Largest number of chatrooms in the page
+        """
         event = {
             "type": EventType.GET_CHATROOM_LIST.value,
+            "offset": offset,
+            "limit": limit,
         }
 
         if (await self.send(event)) == StatusType.ERROR:
             print("Failed to get chatroom list")
-            return None
-        
-    
-    async def create_chatroom(self):
+            return StatusType.ERROR
+
+        return StatusType.OK
+
+
+    async def subscribe_chatroom_list(self, limit: int = SystemServer.PAGE_SIZE):
         """
-        Send a request of creating a chatroom to the system server
+        Send a request of getting the first page of the chatroom list, then every
+        change of it, to the system server
+
+        Parameters
+        ------------
+        limit: int, default = `SystemServer.PAGE_SIZE`
+            Largest number of chatrooms in the first page
         """
         event = {
-            "type": EventType.CREATE_CHATROOM.value,
+            "type": EventType.SUBSCRIBE_CHATROOM_LIST.value,
+            "limit": limit,
         }
 
         if (await self.send(event)) == StatusType.ERROR:
-            print("Failed to create chatroom")
+            print("Failed to subscribe to chatroom list")
             return StatusType.ERROR
-        
+
         return StatusType.OK
+        
+    
+    async def create_chatroom(self, *, recording_format: str = RECORDING_FORMAT, audio_codec: str = AUDIO_CODEC) -> dict | None:
+        """
+        Request the system server to create a chatroom, and wait for the address
+        of its chatroom server
+
+        Parameters
+        ------------
+        recording_format: str, default = `RECORDING_FORMAT`
+            Encoding of the recordings of the chatroom, "pcm" or "adpcm"
+
+        audio_codec: str, default = `AUDIO_CODEC`
+            Codec of the audio sent in the chatroom, "float32", "pcm16", "mulaw" or "adpcm"
+
+        Returns
+        ---------
+        `CHATROOM_PORT` event replied, `None` if failed
+        """
+        event = {
+            "type": EventType.CREATE_CHATROOM.value,
+            "recording_format": recording_format,
+            "audio_codec": audio_codec,
+        }
+
+        if (reply := await self.request(event)) is None or "error" in reply:
+            print("Failed to create chatroom" + ("" if reply is None else f": {reply['error']}"))
+            return None
 
+        return reply
 
-    async def join_chatroom(self, chatroom_ID: int):
+
+    async def join_chatroom(self, chatroom_ID: int) -> dict | None:
         """
-        Send a request of joining a chatroom to the server
+        Request the system server to join a chatroom, and wait for the address of
+        its chatroom server
 
         Parameters
         ------------
         chatroom_ID: int
             ID of the chatroom to be joined
+
+        Returns
+        ---------
+        `CHATROOM_PORT` event replied, `None` if failed
         """
         event = {
             "type": EventType.JOIN_CHATROOM.value,
             "chatroom_ID": chatroom_ID,
         }
 
-        if (await self.send(event)) == StatusType.ERROR:
-            return StatusType.ERROR
-        
-        return StatusType.OK
+        if (reply := await self.request(event)) is None or "error" in reply:
+            print(f"Failed to join chatroom {chatroom_ID}" + ("" if reply is None else f": {reply['error']}"))
+            return None
+
+        return reply
     
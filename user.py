@@ -1,14 +1,15 @@
 from status_type import StatusType
 from chatroom import ChatroomClient, ParticipantData
 from system import SystemClient
-from audio import Audio
-from image import Image
+from audio import Audio, VoiceActivityDetector
+from image import Image, RateController, ChangeDetector, TileEncoder, BackgroundFilter
 
 import asyncio
 import numpy as np
 import threading
+import time
 
-from config import ENHANCEMENT
+from config import ENHANCEMENT, VIDEO_DELTA, AUDIO_VAD
 
 
 class User:
@@ -17,6 +18,10 @@ class User:
     GUI and audio
     """
 
+    COMFORT_NOISE_INTERVAL = .5
+    """Period (s) of telling the background noise level while the microphone audio is withheld"""
+
+
     def __init__(self, *, sys_loop = None):
         # connections to server
         self.system_client = SystemClient(self)
@@ -33,6 +38,10 @@ class User:
         """Whether the microphone is unmuted"""
         self.speaker = False
         """Whether the speaker is unmuted"""
+        self.vad = VoiceActivityDetector()
+        """Detects the microphone audio to be withheld for being silent, if `AUDIO_VAD` is enabled"""
+        self.comfort_noise = {}
+        """Dict `{participant ID: float}` of the background noise level of each silent participant"""
 
         # webcam capture
         self.image = Image()
@@ -41,18 +50,38 @@ class User:
         """Whether the webcam is turned on"""
         self.webcam_filter = False
         """Whether the webcam filter is turned on"""
+        self.background_filter = BackgroundFilter()
+        """Blurs or flattens the background of webcam images"""
+        self.webcam_background = False
+        """Whether the background filter is turned on"""
+        self.rate_controller = RateController()
+        """Adapts the webcam stream to the available bandwidth"""
+        self.change_detector = ChangeDetector()
+        """Skips webcam frames of a static scene"""
+        self.tile_encoder = TileEncoder()
+        """Encodes the changed tiles of webcam frames, if `VIDEO_DELTA` is enabled"""
 
         self.sys_loop = sys_loop or asyncio.get_event_loop()
 
         # for updating GUI
-        self.chatroom_list = None
-        """List of chatrooms in the voicechat system"""
+        self.chatroom_list = {}
+        """Dict `{chatroom ID: number of participants}` of the chatrooms in the voicechat system"""
         self.chatroom_ID = None
         """ID of connected chatroom server"""
         self.participant_data = None
         """List of participants in current chatroom and their status"""
+        self.participant_images = {}
+        """Dict `{participant ID: image}` of the last decoded webcam image of each participant"""
+        self.active_speakers = []
+        """IDs of the participants speaking in the chatroom, loudest first"""
+        self.pinned = set()
+        """IDs of the participants whose webcam is always shown"""
         self.recording_status = False
         """Whether a recording has been started in the chatroom"""
+        self.recording_progress = None
+        """Fraction of a stopped recording finalized by the chatroom server, `None` if none is in progress"""
+        self.recordings = []
+        """ID, filename and size of each recording file available for download"""
 
 
     async def exec(self):
@@ -73,8 +102,11 @@ class User:
 
 
     async def connect_server(self):
-        """Connect the user to the system server"""
-        return await self.system_client.connect()
+        """Connect the user to the system server, and keep the chatroom list up to date"""
+        if (await self.system_client.connect()) == StatusType.ERROR:
+            return StatusType.ERROR
+
+        return await self.system_client.subscribe_chatroom_list()
 
 
     async def disconnect_server(self):
@@ -87,22 +119,29 @@ class User:
         return await self.system_client.disconnect()
 
 
-    async def wait_chatroom_connection(self):
-        """Wait until the chatroom client is connected to a chatroom server"""
-        while True:
-            if self.connected_chatroom: return
-            await asyncio.sleep(0)
+    async def enter_chatroom(self, address: dict):
+        """
+        Connect to a chatroom server and start chatting
+
+        Parameters
+        ------------
+        address: dict
+            `CHATROOM_PORT` event replied by the system server
+        """
+        if (await self.chatroom_client.connect(address["host"], address["port"], address["ID"])) == StatusType.ERROR:
+            return
+
+        _ = asyncio.create_task(self.chat())
 
 
     async def create_chatroom(self):
         """Create a new chatroom"""
-        if not self.connect_server: return
+        if not self.connected_server: return
 
-        if (await self.system_client.create_chatroom()) == StatusType.ERROR:
+        if (address := await self.system_client.create_chatroom()) is None:
             return
-        
-        await self.wait_chatroom_connection()
-        _ = asyncio.create_task(self.chat())
+
+        await self.enter_chatroom(address)
 
 
     async def join_chatroom(self, chatroom_ID: int):
@@ -114,13 +153,12 @@ class User:
         chatroom_ID: int
             ID of the chatroom to be joined
         """
-        if not self.connect_server: return
+        if not self.connected_server: return
 
-        if (await self.system_client.join_chatroom(chatroom_ID)) == StatusType.ERROR:
+        if (address := await self.system_client.join_chatroom(chatroom_ID)) is None:
             return
-        
-        await self.wait_chatroom_connection()
-        _ = asyncio.create_task(self.chat())
+
+        await self.enter_chatroom(address)
 
 
     async def quit_chatroom(self):
@@ -140,26 +178,17 @@ class User:
         if self.webcam:
             self.webcam = False
             self.webcam_filter = False
+            self.webcam_background = False
             self.image.close()
 
         self.participant_data = None
+        self.participant_images = {}
+        self.active_speakers = []
+        self.pinned = set()
+        self.set_comfort_noise({})
         self.recording_status = False
-
-
-    async def request_chatroom_list(self) -> list[int]:
-        """
-        Get the list of existing chatrooms
-        
-        Returns
-        ------------
-        List of chatroom IDs
-        """
-        if not self.connected_server: return []
-        
-        if (await self.system_client.request_chatroom_list()) == StatusType.ERROR:
-            return None
-
-        return self.chatroom_list
+        self.recording_progress = None
+        self.recordings = []
 
 
     async def request_participant_data(self) -> list[tuple[int, bool]]:
@@ -172,7 +201,7 @@ class User:
         """
         if not self.connected_chatroom: return []
 
-        if (await self.chatroom_client.request_participant_data()) == StatusType.ERROR:
+        if (await self.chatroom_client.request_participant_data()) is None:
             return None
 
         return self.participant_data
@@ -193,65 +222,199 @@ class User:
         # recreate ParticipantData object
         participant_data = [ParticipantData(**p) for p in p_data]
 
-        # decode webcam image
+        # decode webcam image, or keep showing the last one if the server withheld it
         for p in participant_data:
-            if p.image is not None:
+            # the server sends a complete image once the webcam is shown again
+            if not p.webcam or not p.video:
+                self.participant_images.pop(p.id, None)
+
+            elif p.image is not None:
                 p.image = np.array(p.image, dtype=np.uint8)
                 p.image = Image.decode(p.image)
+                self.participant_images[p.id] = p.image
+
+            elif p.tiles:
+                p.image = await self.compose_tiles(p)
+
+            else:
+                p.image = self.participant_images.get(p.id)
             
             await asyncio.sleep(0)
 
         self.participant_data = participant_data
+
+        # stop the noise of the participants who left or muted
+        IDs = {p.id for p in participant_data if p.microphone}
+        if any(ID not in IDs for ID in self.comfort_noise):
+            self.set_comfort_noise({ID: level for ID, level in self.comfort_noise.items() if ID in IDs})
         
 
-    async def request_recording_status(self):
-        """Recording recording status in the chatroom"""
+    async def compose_tiles(self, p: ParticipantData) -> np.ndarray | None:
+        """
+        Decode the tiles of a participant's webcam image, and draw them on the
+        last image of the participant
+
+        Parameters
+        ------------
+        p: ParticipantData
+            Participant data with tiles
+
+        Returns
+        ------------
+        The composed image, or `None` if no complete image is available
+        """
+        rows, cols = p.grid
+        h, w = p.size
+
+        # copy the last image, as it may still be drawn by the GUI
+        image = self.participant_images.get(p.id)
+        if image is not None and image.shape[:2] == (h, w):
+            image = image.copy()
+
+        # the tiles cannot be drawn without a complete image, request all of them
+        elif len(p.tiles) == rows * cols:
+            image = np.zeros((h, w, 3), dtype=np.uint8)
+
+        else:
+            self.participant_images.pop(p.id, None)
+            await self.chatroom_client.request_keyframe(p.id)
+            return None
+
+        tile_slices = Image.split_tiles((h, w), (rows, cols))
+        for i, data in p.tiles:
+            ys, xs = tile_slices[i]
+            tile = Image.decode(np.array(data, dtype=np.uint8))
+            if tile is not None and tile.shape == image[ys, xs].shape:
+                image[ys, xs] = tile
+
+        self.participant_images[p.id] = image
+        return image
+
+
+    async def request_recording_status(self) -> bool | None:
+        """Get the recording status in the chatroom, `None` if failed"""
         if not self.connected_chatroom: return False
 
-        await self.chatroom_client.request_recording_status()
+        if (await self.chatroom_client.request_recording_status()) is None:
+            return None
+
         return self.recording_status
     
 
     def capture_audio(self):
         """Capture voice input from the user, and send to chatroom server"""
+        noise_time = -np.inf
         while self.connected_chatroom:
             if not self.microphone: continue
 
             # get audio data from client's microphone
-            if (data := self.audio.capture()) is None: continue
+            if (captured := self.audio.capture()) is None: continue
+            data, timestamp = captured
+
+            # withhold silence, only telling the background noise level now and then
+            if AUDIO_VAD and not self.vad.detect(data, timestamp):
+                if timestamp - noise_time < User.COMFORT_NOISE_INTERVAL: continue
+                noise_time = timestamp
+                result = asyncio.run_coroutine_threadsafe(
+                    self.chatroom_client.send_comfort_noise(self.vad.noise, timestamp=timestamp),
+                    self.sys_loop)
+                if result.result() == StatusType.ERROR: break
+                continue
+
+            # the first silent block after speech is told at once
+            noise_time = -np.inf
 
-            data = data.tolist()
             result = asyncio.run_coroutine_threadsafe(
-                self.chatroom_client.send_audio_data(data), self.sys_loop)
+                self.chatroom_client.send_audio_frame(data, timestamp=timestamp, rate=self.audio.input_rate),
+                self.sys_loop)
             status = result.result()
             if status == StatusType.ERROR: break
 
 
-    async def play(self, data: list):
+    async def play(self, data: list | np.ndarray, participant_ID: int = None):
         """Play the audio data received from server through user's speakers"""
+        if participant_ID in self.comfort_noise:
+            self.set_comfort_noise({ID: level for ID, level in self.comfort_noise.items() if ID != participant_ID})
+
         if not self.speaker: return
 
-        assert isinstance(data, list)
+        assert isinstance(data, (list, np.ndarray))
 
         # play the audio data through client's speaker
         data = np.asarray(data)
         self.audio.play(data)
 
 
+    def receive_comfort_noise(self, participant_ID: int, level: float):
+        """
+        Play noise at the background level of a participant who went silent, until
+        its audio is received again
+
+        Parameters
+        ------------
+        participant_ID: int
+
+        level: float
+            RMS level of the background noise of the participant, 0 to stop it
+        """
+        comfort_noise = {**self.comfort_noise, participant_ID: level}
+        if level <= 0: del comfort_noise[participant_ID]
+        self.set_comfort_noise(comfort_noise)
+
+
+    def set_comfort_noise(self, comfort_noise: dict[int, float]):
+        """Set the background noise level of the silent participants, whose noise is played together"""
+        self.comfort_noise = comfort_noise
+        self.audio.comfort_noise = float(np.sqrt(sum(level ** 2 for level in comfort_noise.values())))
+
+
     def capture_image(self):
         """Capture image input from the user's webcam, and send to chatroom server"""
         while self.connected_chatroom:
             if not self.webcam: continue
 
+            # keep to the frame rate set by the rate controller
+            if (delay := self.rate_controller.wait()) > 0:
+                time.sleep(delay)
+                continue
+
             # get image data from client's webcam           
             if (image := self.image.capture()) is None: continue
 
-            image = Image.encode(image) # encode image
-            data = image.tolist() # flatten to list
+            # skip the frame if the connection is backlogged, so that audio is not delayed
+            if self.chatroom_client.queue_depth > RateController.QUEUE_LIMIT:
+                self.rate_controller.congested()
+                continue
+
+            # skip the frame if the scene has not changed
+            if not self.change_detector.changed(image):
+                self.rate_controller.skip()
+                continue
+
+            image = Image.resize(image, self.rate_controller.scale)
+
+            if self.webcam_background:
+                image = self.background_filter.apply(image, quality=self.rate_controller.quality)
+
+            # only send the tiles of the image that changed
+            if VIDEO_DELTA:
+                keyframe, tiles = self.tile_encoder.encode(image, quality=self.rate_controller.quality)
+                if len(tiles) == 0:
+                    self.rate_controller.skip()
+                    continue
+
+                self.rate_controller.sent(sum(tile.nbytes for _, tile in tiles))
+                coroutine = self.chatroom_client.send_image_tiles(
+                    tiles, grid=self.tile_encoder.grid, size=image.shape[:2], keyframe=keyframe)
+
+            else:
+                image = Image.encode(image, quality=self.rate_controller.quality) # encode image
+                if image is StatusType.ERROR: continue
+                self.rate_controller.sent(image.nbytes)
+                coroutine = self.chatroom_client.send_image_data(image)
 
             # status = await self.chatroom_client.send_image_data(data)
-            result = asyncio.run_coroutine_threadsafe(
-                self.chatroom_client.send_image_data(data), self.sys_loop)
+            result = asyncio.run_coroutine_threadsafe(coroutine, self.sys_loop)
             status = result.result()
             if status == StatusType.ERROR: break
 
@@ -262,6 +425,7 @@ class User:
 
         # for receiving data from the chatroom server
         client_task = asyncio.create_task(self.chatroom_client.listener())
+        await self.chatroom_client.request_recording_list()
 
         # start audio capturing and playing
         self.audio.start_capturing()
@@ -290,12 +454,14 @@ class User:
         if self.webcam: self.image.close()
         self.webcam = False
         self.webcam_filter = False
+        self.webcam_background = False
         if ENHANCEMENT: image_thread.join()
 
 
     async def toggle_microphone(self):
         """Toggle mute and unmute microphone"""
         if not self.microphone:
+            self.vad.reset()
             self.audio.start_capturing()
         else:
             self.audio.stop_capturing()
@@ -319,6 +485,27 @@ class User:
         return self.speaker
 
 
+    async def toggle_pin(self, participant_ID: int) -> bool:
+        """
+        Pin or unpin a participant, whose webcam is always shown while pinned
+
+        Parameters
+        ------------
+        participant_ID: int
+
+        Returns
+        ------------
+        Whether the participant is pinned
+        """
+        pinned = participant_ID not in self.pinned
+        if (await self.chatroom_client.pin_participant(participant_ID, pinned)) == StatusType.ERROR:
+            return not pinned
+
+        # replaced rather than modified, as it is read by the GUI
+        self.pinned = self.pinned | {participant_ID} if pinned else self.pinned - {participant_ID}
+        return pinned
+
+
     async def toggle_webcam(self):
         """Toggle on and off of webcam"""
         if not ENHANCEMENT: return False
@@ -327,6 +514,8 @@ class User:
             self.image.close()
         else:
             self.image.open()
+            self.change_detector.reset()
+            self.tile_encoder.reset()
 
         await self.chatroom_client.toggle_webcam()
 
@@ -347,6 +536,60 @@ class User:
         return self.webcam_filter
 
 
+    async def toggle_background(self):
+        """Toggle webcam background filter on and off"""
+        if not self.webcam: return False
+
+        if self.webcam_background:
+            print("Background filter turned off, saved "
+                  f"{self.background_filter.saving:.0%} of webcam image size")
+        else:
+            print("Background filter turned on")
+
+        self.webcam_background = not self.webcam_background
+        return self.webcam_background
+
+
     async def toggle_recording(self):
         """Toggle start and stop recording"""
         await self.chatroom_client.toggle_recording()
+
+
+    async def download_recording_segment(self, recording_ID: int, start: float, end: float):
+        """
+        Download a time range of a recording file from the chatroom server
+
+        Parameters
+        -----------
+        recording_ID: int
+            ID of the recording file
+
+        start: float
+            Start time (s) of the range
+
+        end: float
+            End time (s) of the range
+        """
+        await self.chatroom_client.request_recording_segment(recording_ID, start, end)
+
+
+    async def save_replay(self):
+        """Save the latest audio of the chatroom as a recording file"""
+        await self.chatroom_client.request_replay()
+
+
+    async def download_recording(self, recording_ID: int):
+        """
+        Download a recording file from the chatroom server
+
+        Parameters
+        ------------
+        recording_ID: int
+            ID of the recording file to be downloaded
+        """
+        if not self.connected_chatroom: return
+
+        for recording in self.recordings:
+            if recording["ID"] == recording_ID:
+                await self.chatroom_client.request_recording(
+                    recording_ID, recording["filename"], recording["size"])
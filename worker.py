@@ -0,0 +1,278 @@
+from status_type import StatusType
+from chatroom import ChatroomServer
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import websockets
+from http import HTTPStatus
+
+from config import HOST, CHATROOM_IDLE_TIMEOUT
+
+
+class ChatroomWorker:
+    """
+    Handles a worker process hosting chatrooms on its own port and event loop, on
+    the side of the system server. Commands are sent to the process and its load
+    is reported back through pipes.
+    """
+
+    def __init__(self, port: int, *, host: str = HOST):
+        self.host = host
+        """IP address the chatrooms of this worker are hosted at"""
+        self.port = port
+        """Port the chatrooms of this worker are hosted on"""
+
+        self.process = None
+        """Worker process"""
+        self.commands = None
+        """Pipe end the commands are sent through"""
+        self.reports = None
+        """Pipe end the reports are received from"""
+        self.reader = None
+        """Thread the reports are received in, so that no thread of the default executor is held"""
+
+        self.pending = {}
+        """Dict `{chatroom ID: Future}` of the chatrooms being created"""
+
+
+    @property
+    def started(self) -> bool:
+        """Whether the worker process is running"""
+        return self.process is not None and self.process.is_alive()
+
+
+    @property
+    def node_ID(self) -> str:
+        """ID of the worker as a node of a room registry"""
+        return f"{self.host}:{self.port}"
+
+
+    async def start(self):
+        """Start the worker process"""
+        # spawned, so that the process does not inherit the event loop of the system server
+        context = multiprocessing.get_context("spawn")
+        worker_commands, self.commands = context.Pipe(duplex=False)
+        self.reports, worker_reports = context.Pipe(duplex=False)
+
+        # not daemonic, so that the worker can start the processes denoising the
+        # recordings; it is stopped by `close`, or once the pipes are closed
+        self.process = context.Process(
+            target=WorkerServer.run, args=(self.host, self.port, worker_commands, worker_reports))
+        self.process.start()
+        self.reader = ThreadPoolExecutor(max_workers=1)
+
+        # wait until the worker has started its server
+        if await asyncio.get_running_loop().run_in_executor(self.reader, self.reports.recv) != ("started",):
+            print(f"Cannot start chatroom worker at port {self.host}:{self.port}")
+            return StatusType.ERROR
+
+        print(f"Chatroom worker started at port {self.host}:{self.port}")
+        return StatusType.OK
+
+
+    async def listen(self, *, on_load = None, on_closed = None):
+        """
+        Receive the reports of the worker process until it stops, its chatrooms are
+        gone then
+
+        Parameters
+        -----------
+        on_load: Callable[[dict], None], default = `None`
+            Called with the dict `{chatroom ID: int}` of the number of participants in
+            each chatroom of the worker whenever it changes
+
+        on_closed: Callable[[int], None], default = `None`
+            Called with the ID of each chatroom the worker closed for being idle
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                report, *args = await loop.run_in_executor(self.reader, self.reports.recv)
+            except (EOFError, OSError):
+                break
+
+            match report:
+                # a chatroom accepts clients
+                case "created":
+                    if (future := self.pending.pop(args[0], None)) is not None and not future.done():
+                        future.set_result(None)
+
+                # number of participants in each chatroom
+                case "load":
+                    if on_load is not None: on_load(args[0])
+
+                # a chatroom was closed for being idle
+                case "closed":
+                    if on_closed is not None: on_closed(args[0])
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("the worker process stopped"))
+        self.pending = {}
+
+
+    async def create_chatroom(self, chatroom_ID: int, **options):
+        """
+        Create a chatroom in the worker process, and wait until it accepts clients
+
+        Parameters
+        -----------
+        chatroom_ID: int
+            ID of the chatroom
+
+        options:
+            Keyword arguments of `ChatroomServer`
+        """
+        future = self.pending[chatroom_ID] = asyncio.get_running_loop().create_future()
+        try:
+            self.commands.send(("create", chatroom_ID, options))
+            await future
+
+        except OSError:
+            self.pending.pop(chatroom_ID, None)
+            print(f"Cannot create chatroom {chatroom_ID} on worker at port {self.host}:{self.port}")
+            return StatusType.ERROR
+
+        return StatusType.OK
+
+
+    async def close(self):
+        """Close the chatrooms and stop the worker process"""
+        if self.process is None: return StatusType.OK
+
+        try:
+            self.commands.send(("close",))
+        except OSError:
+            pass
+
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.commands.close()
+        self.reports.close()
+        self.reader.shutdown(wait=False)
+
+        print(f"Chatroom worker at port {self.host}:{self.port} is closed")
+        self.process = None
+        return StatusType.OK
+
+
+
+class WorkerServer:
+    """Hosts chatrooms on one port, each at its own path, inside a worker process"""
+
+    LOAD_INTERVAL = 1.0
+    """Period (s) of checking the load of the worker and the idle chatrooms"""
+
+
+    def __init__(self, host: str, port: int, commands, reports):
+        self.host = host
+        self.port = port
+        self.commands = commands
+        """Pipe end the commands of the system server are received from"""
+        self.reports = reports
+        """Pipe end the reports to the system server are sent through"""
+
+        self.server = None
+        self.reader = ThreadPoolExecutor(max_workers=1)
+        """Thread the commands are received in, so that no thread of the default executor is held"""
+        self.chatroom_list = {}
+        """Dict `{chatroom ID: ChatroomServer}` of the chatrooms hosted"""
+        self.idle_since = {}
+        """Dict `{chatroom ID: float}` of the time each chatroom without participants became empty"""
+
+
+    @staticmethod
+    def run(host: str, port: int, commands, reports):
+        """Entry point of the worker process"""
+        try:
+            asyncio.run(WorkerServer(host, port, commands, reports).serve())
+        except KeyboardInterrupt:
+            pass
+
+
+    async def serve(self):
+        """Host the chatrooms until the system server closes the worker"""
+        try:
+            self.server = await websockets.serve(
+                self.handler, host=self.host, port=self.port, process_request=self.process_request)
+
+        except OSError as e:
+            self.reports.send(("error", str(e)))
+            return
+
+        self.reports.send(("started",))
+        monitor_task = asyncio.create_task(self.monitor())
+
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                command, *args = await loop.run_in_executor(self.reader, self.commands.recv)
+            except (EOFError, OSError):
+                break
+
+            match command:
+                case "create":
+                    chatroom_ID, options = args
+                    chatroom_server = ChatroomServer(ID=chatroom_ID, **options)
+                    await chatroom_server.start()
+                    self.chatroom_list[chatroom_ID] = chatroom_server
+                    self.reports.send(("created", chatroom_ID))
+
+                case "close":
+                    break
+
+        monitor_task.cancel()
+        for chatroom_server in self.chatroom_list.values():
+            await chatroom_server.close()
+
+        self.server.close()
+        await self.server.wait_closed()
+        self.reader.shutdown(wait=False)
+
+
+    async def monitor(self):
+        """
+        Close the chatrooms left empty for `CHATROOM_IDLE_TIMEOUT`, and report the
+        number of participants in each chatroom whenever it changes
+        """
+        loop = asyncio.get_running_loop()
+        load = {}
+        while True:
+            await asyncio.sleep(WorkerServer.LOAD_INTERVAL)
+
+            for chatroom_ID, chatroom_server in list(self.chatroom_list.items()):
+                # finalizing recordings keeps a chatroom busy
+                if len(chatroom_server.participant_data) > 0 or len(chatroom_server.finalize_tasks) > 0:
+                    self.idle_since.pop(chatroom_ID, None)
+                    continue
+
+                idle_since = self.idle_since.setdefault(chatroom_ID, loop.time())
+                if CHATROOM_IDLE_TIMEOUT is not None and loop.time() - idle_since >= CHATROOM_IDLE_TIMEOUT:
+                    await self.close_chatroom(chatroom_ID)
+
+            if (current := {ID: len(c.participant_data) for ID, c in self.chatroom_list.items()}) != load:
+                load = current
+                self.reports.send(("load", load))
+
+
+    async def close_chatroom(self, chatroom_ID: int):
+        """Close a chatroom and report it to the system server, which may reuse its ID"""
+        chatroom_server = self.chatroom_list.pop(chatroom_ID)
+        self.idle_since.pop(chatroom_ID, None)
+        await chatroom_server.close()
+        self.reports.send(("closed", chatroom_ID))
+
+
+    async def process_request(self, path: str, request_headers):
+        """Reject connections to a chatroom that is not hosted here, before the handshake"""
+        if ChatroomServer.chatroom_ID(path) not in self.chatroom_list:
+            return HTTPStatus.NOT_FOUND, [], b"Chatroom not found\n"
+
+
+    async def handler(self, websocket: websockets.WebSocketServerProtocol):
+        """Hand over a connection to the chatroom at its path"""
+        if (chatroom_server := self.chatroom_list.get(ChatroomServer.chatroom_ID(websocket.path))) is not None:
+            await chatroom_server.handler(websocket)